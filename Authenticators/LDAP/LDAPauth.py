@@ -102,6 +102,7 @@
 #            * ice-python
 #            * python-ldap
 #            * daemon (when run as a daemon)
+#        * authcore.py, either next to this script or in a directory above it
 #    If you are using Ubuntu/Debian (only Ubuntu 20.04 was tested) the following packages provide these:
 #        * python3
 #        * python3-zeroc-ice
@@ -109,31 +110,35 @@
 #        * python3-daemon
 #        * zeroc-ice-slice
 
+import os
 import sys
 import ldap
-import Ice
-import _thread
-import urllib.request, urllib.error, urllib.parse
+import ldap.dn
+from ldap.controls import SimplePagedResultsControl
+import time
 import logging
-import configparser
 
-from threading  import Timer
-from optparse   import OptionParser
+from threading  import Condition, Lock, Thread, Event, BoundedSemaphore
 from logging    import (debug,
                         info,
                         warning,
-                        error,
-                        critical,
-                        exception,
-                        getLogger)
-
-def x2bool(s):
-    """Helper function to convert strings from the config to bool"""
-    if isinstance(s, bool):
-        return s
-    elif isinstance(s, str):
-        return s.lower() in ['1', 'true']
-    raise ValueError()
+                        error)
+
+# The shared core lives in the Authenticators directory or next to this script
+core = os.path.dirname(os.path.abspath(__file__))
+while not os.path.exists(os.path.join(core, 'authcore.py')) and os.path.dirname(core) != core:
+    core = os.path.dirname(core)
+sys.path.insert(1, core)
+
+import authcore
+from authcore import (x2bool,
+                      endpoint_list,
+                      call_stats,
+                      connectionPool,
+                      nameCache,
+                      negativeCache,
+                      trigramIndex,
+                      serve)
 
 #
 #--- Default configuration values
@@ -149,20 +154,44 @@ default = { 'ldap':(('ldap_uri', str, 'ldap://127.0.0.1'),
                     ('display_attr', str, 'displayName'),
                     ('group_dn', str, 'ou=Groups,dc=example,dc=org'),
                     ('group_attr', str, 'member'),
+                    ('group_membership', str, 'search'),
+                    ('memberof_attr', str, 'memberOf'),
+                    ('group_refresh', int, 300),
                     ('provide_info', x2bool, False),
                     ('mail_attr', str, 'mail'),
                     ('provide_users', x2bool, False),
-                    ('use_start_tls', x2bool, False)),
+                    ('use_start_tls', x2bool, False),
+                    ('pool_min', int, 1),
+                    ('pool_max', int, 5),
+                    ('pool_timeout', int, 10),
+                    ('pool_idle', int, 600),
+                    ('pool_check', int, 30),
+                    ('op_timeout', int, 10),
+                    ('max_operations', int, 0),
+                    ('multiplex', int, 0),
+                    ('page_size', int, 500),
+                    ('users_snapshot', x2bool, False),
+                    ('snapshot_refresh', int, 60),
+                    ('snapshot_full_refresh', int, 3600),
+                    ('snapshot_max_results', int, 0)),
 
             'user':(('id_offset', int, 1000000000),
                     ('reject_on_error', x2bool, True),
-                    ('reject_on_miss', x2bool, True)),
+                    ('reject_on_miss', x2bool, True),
+                    ('name_cache_size', int, 10000),
+                    ('name_cache_ttl', int, 3600),
+                    ('unknown_cache_size', int, 10000),
+                    ('unknown_cache_ttl', int, 60),
+                    ('unknown_query_interval', int, 5)),
            
             'ice':(('host', str, '127.0.0.1'),
                    ('port', int, 6502),
                    ('slice', str, 'Murmur.ice'),
                    ('secret', str, ''),
-                   ('watchdog', int, 30)),
+                   ('watchdog', int, 30),
+                   ('reconnect_max', int, 120),
+                   ('endpoints', endpoint_list, []),
+                   ('callback_host', str, '')),
                    
             'iceraw':None,
                    
@@ -173,711 +202,1027 @@ default = { 'ldap':(('ldap_uri', str, 'ldap://127.0.0.1'),
                        ('host', str, 'localhost'),
                        ('port', int, '4063')),
                        
+            'stats':(('host', str, '127.0.0.1'),
+                     ('port', int, 0),
+                     ('file', str, ''),
+                     ('interval', int, 60)),
+
             'log':(('level', int, logging.DEBUG),
                    ('file', str, 'LDAPauth.log'))}
  
 #
 #--- Helper classes
 #
-class config(object):
+class threadLdapException(Exception): pass
+class threadLDAP(connectionPool):
     """
-    Small abstraction for config loading
+    Small abstraction to handle a bounded pool of LDAP connections bound
+    with the service account (or anonymously) shared by multiple threads
     """
 
-    def __init__(self, filename = None, default = None):
-        if not filename or not default: return
-        cfg = configparser.ConfigParser()
-        cfg.optionxform = str
-        cfg.read(filename)
-        
-        for h,v in default.items():
-            if not v:
-                # Output this whole section as a list of raw key/value tuples
-                try:
-                    self.__dict__[h] = cfg.items(h)
-                except configparser.NoSectionError:
-                    self.__dict__[h] = []
+    section = 'ldap'
+    kind = 'LDAP'
+    exception = threadLdapException
+
+    lock = Condition()
+    idle_connections = [] # (connection, last use) tuples, most recently used last
+    connection_count = 0
+    operations = None # Semaphore limiting the operations in flight
+    multiplexed = [] # multiplexedLDAP connections used for searches
+    stats = {'checkouts': 0,
+             'waits': 0,
+             'wait_time': 0.0,
+             'max_wait': 0.0,
+             'timeouts': 0,
+             'user_binds': 0,
+             'op_timeouts': 0,
+             'throttled': 0}
+
+    def start(cls):
+        """
+        Sets up the operation limit and the multiplexed connections and
+        opens the first pooled connections
+        """
+        if cfg.ldap.max_operations > 0:
+            cls.operations = BoundedSemaphore(cfg.ldap.max_operations)
+        for i in range(cfg.ldap.multiplex):
+            cls.multiplexed.append(multiplexedLDAP('LDAPMultiplex-%d' % i))
+        cls.fill()
+    start = classmethod(start)
+
+    def begin_operation(cls):
+        """
+        Waits up to op_timeout seconds for one of the max_operations slots
+        so a slow directory cannot tie up every Ice thread at once
+        """
+        if cls.operations is None:
+            return
+        if not cls.operations.acquire(timeout = cfg.ldap.op_timeout if cfg.ldap.op_timeout > 0 else None):
+            cls.count('throttled')
+            error('More than %d LDAP operations in flight, giving up', cfg.ldap.max_operations)
+            raise threadLdapException()
+    begin_operation = classmethod(begin_operation)
+
+    def end_operation(cls):
+        if cls.operations is not None:
+            cls.operations.release()
+    end_operation = classmethod(end_operation)
+
+    def initialize(cls):
+        """
+        Opens a new, still unbound connection and starts TLS on it if
+        configured
+        """
+        if cfg.ldap.use_start_tls:
+            # try StartTLS: global options
+            ldap.set_option(ldap.OPT_X_TLS_REQUIRE_CERT, ldap.OPT_X_TLS_NEVER)
+
+        ldap_trace = 0 # Change to 1 for more verbose trace
+        con = ldap.initialize(cfg.ldap.ldap_uri, ldap_trace)
+
+        if cfg.ldap.op_timeout > 0:
+            # Give up on unresponsive servers instead of blocking forever,
+            # covers connecting as well as the synchronous operations
+            con.set_option(ldap.OPT_NETWORK_TIMEOUT, cfg.ldap.op_timeout)
+            con.set_option(ldap.OPT_TIMEOUT, cfg.ldap.op_timeout)
+            con.timeout = cfg.ldap.op_timeout
+
+        if cfg.ldap.use_start_tls:
+            # try StartTLS: connection specific options
+            con.set_option(ldap.OPT_PROTOCOL_VERSION, 3)
+            con.set_option(ldap.OPT_X_TLS, ldap.OPT_X_TLS_DEMAND)
+            con.set_option(ldap.OPT_X_TLS_DEMAND, True)
+            try:
+                con.start_tls_s()
+            except ldap.LDAPError as e:
+                warning('could not initiate StartTLS, e = ' + str(e))
+                cls.close(con)
+                raise threadLdapException()
+        return con
+    initialize = classmethod(initialize)
+
+    def connect(cls):
+        info('Connecting to LDAP server (%s), pool slot %d of %d',
+             cfg.ldap.ldap_uri, cls.connection_count, cfg.ldap.pool_max)
+
+        con = cls.initialize()
+        try:
+            if cfg.ldap.bind_dn:
+                # Bind the functional account to search the directory.
+                con.simple_bind_s(cfg.ldap.bind_dn, cfg.ldap.bind_pass)
             else:
-                self.__dict__[h] = config()
-                for name, conv, vdefault in v:
-                    try:
-                        self.__dict__[h].__dict__[name] = conv(cfg.get(h, name))
-                    except (ValueError, configparser.NoSectionError, configparser.NoOptionError):
-                        self.__dict__[h].__dict__[name] = vdefault
-                    
+                # Explicit anonymous bind
+                con.simple_bind_s()
+        except ldap.INVALID_CREDENTIALS:
+            con.unbind()
+            if cfg.ldap.bind_dn:
+                warning('Invalid credentials for bind_dn=' + cfg.ldap.bind_dn)
+            else:
+                warning('Failed anonymous bind')
+            raise threadLdapException()
+        except ldap.LDAPError as e:
+            error('Could not connect to LDAP server: %s', str(e))
+            cls.close(con)
+            raise threadLdapException()
+        return con
+    connect = classmethod(connect)
 
-def do_main_program():
-    #
-    #--- Authenticator implementation
-    #    All of this has to go in here so we can correctly daemonize the tool
-    #    without loosing the file descriptors opened by the Ice module
-    slicedir = Ice.getSliceDir()
-    if not slicedir:
-        slicedir = ["-I/usr/share/Ice/slice", "-I/usr/share/slice"]
-    else:
-        slicedir = ['-I' + slicedir]
-    Ice.loadSlice('', slicedir + [cfg.ice.slice])
-    import Murmur
-    
-    class LDAPAuthenticatorApp(Ice.Application):
-        def run(self, args):
-            self.shutdownOnInterrupt()
-            
-            if not self.initializeIceConnection():
-                return 1
-
-            if cfg.ice.watchdog > 0:
-                self.failedWatch = True
-                self.checkConnection()
-                
-            # Serve till we are stopped
-            self.communicator().waitForShutdown()
-            self.watchdog.cancel()
-            
-            if self.interrupted():
-                warning('Caught interrupt, shutting down')
-                
-            return 0
-        
-        def initializeIceConnection(self):
-            """
-            Establishes the two-way Ice connection and adds the authenticator to the
-            configured servers
-            """
-            ice = self.communicator()
-            
-            if cfg.ice.secret:
-                debug('Using shared ice secret')
-                ice.getImplicitContext().put("secret", cfg.ice.secret)
-            elif not cfg.glacier.enabled:
-                warning('Consider using an ice secret to improve security')
-                
-            if cfg.glacier.enabled:
-                #info('Connecting to Glacier2 server (%s:%d)', glacier_host, glacier_port)
-                error('Glacier support not implemented yet')
-                #TODO: Implement this
-    
-            info('Connecting to Ice server (%s:%d)', cfg.ice.host, cfg.ice.port)
-            base = ice.stringToProxy('Meta:tcp -h %s -p %d' % (cfg.ice.host, cfg.ice.port))
-            self.meta = Murmur.MetaPrx.uncheckedCast(base)
-        
-            adapter = ice.createObjectAdapterWithEndpoints('Callback.Client', 'tcp -h %s' % cfg.ice.host)
-            adapter.activate()
-            
-            metacbprx = adapter.addWithUUID(metaCallback(self))
-            self.metacb = Murmur.MetaCallbackPrx.uncheckedCast(metacbprx)
-            
-            authprx = adapter.addWithUUID(LDAPAuthenticator())
-            self.auth = Murmur.ServerUpdatingAuthenticatorPrx.uncheckedCast(authprx)
-            
-            return self.attachCallbacks()
-        
-        def attachCallbacks(self, quiet = False):
-            """
-            Attaches all callbacks for meta and authenticators
-            """
-            
-            # Ice.ConnectionRefusedException
-            #debug('Attaching callbacks')
+    def alive(cls, con):
+        try:
+            con.whoami_s()
+        except ldap.LDAPError as e:
+            debug('Pooled LDAP connection failed health check: %s', str(e))
+            return False
+        return True
+    alive = classmethod(alive)
+
+    def close(cls, con):
+        try:
+            con.unbind_s()
+        except ldap.LDAPError:
+            pass
+    close = classmethod(close)
+
+    def search(cls, base, scope, filterstr, attrlist = None):
+        """
+        Runs a search on one of the multiplexed connections if configured
+        or on a pooled connection otherwise and waits for its results
+        """
+        cls.begin_operation()
+        start = time.time()
+        try:
+            if cls.multiplexed:
+                # Spread the searches over the connections by their backlog
+                mux = min(cls.multiplexed, key = lambda m: len(m.pending))
+                return mux.search(base, scope, filterstr, attrlist)
+            return cls.search_pooled(base, scope, filterstr, attrlist)
+        finally:
+            call_stats.stage('ldap_search', time.time() - start)
+            cls.end_operation()
+    search = classmethod(search)
+
+    def search_pooled(cls, base, scope, filterstr, attrlist = None, retry = True):
+        """
+        Runs a synchronous search on a pooled connection. Connections lost
+        in the meantime are replaced and the search is retried once.
+        """
+        con = cls.checkout()
+        try:
+            res = con.search_s(base, scope, filterstr, attrlist)
+        except ldap.TIMEOUT:
+            # The search may still be running, do not reuse the connection
+            cls.count('op_timeouts')
+            error('LDAP search timed out after %ds', cfg.ldap.op_timeout)
+            cls.discard(con)
+            raise threadLdapException()
+        except (ldap.SERVER_DOWN, ldap.CONNECT_ERROR) as e:
+            error('LDAP connection error: %s', str(e))
+            cls.discard(con)
+            if retry:
+                # Make sure we only retry once
+                info('Retrying LDAP operation')
+                return cls.search_pooled(base, scope, filterstr, attrlist, retry = False)
+            error('LDAP operation failed ultimately')
+            raise threadLdapException()
+        except:
+            cls.checkin(con)
+            raise
+
+        cls.checkin(con)
+        return res
+    search_pooled = classmethod(search_pooled)
+
+    def search_paged(cls, base, scope, filterstr, attrlist = None):
+        """
+        Generator yielding the (dn, attributes) results of a search that
+        is fetched with RFC 2696 paged results, page_size entries at a
+        time, so large directories are neither cut at the server's size
+        limit nor held in memory as one response.
+        """
+        cls.begin_operation()
+        spent = 0.0 # Time spent on the directory, the caller's loop excluded
+        start = time.time()
+        try:
+            if cfg.ldap.page_size <= 0:
+                entries = cls.search_pooled(base, scope, filterstr, attrlist)
+                spent, start = time.time() - start, None
+                for entry in entries:
+                    yield entry
+                return
+
+            con = cls.checkout()
+            complete = False
             try:
-                if not quiet: info('Attaching meta callback')
-
-                self.meta.addCallback(self.metacb)
-                
-                for server in self.meta.getBootedServers():
-                    if not cfg.murmur.servers or server.id() in cfg.murmur.servers:
-                        if not quiet: info('Setting authenticator for virtual server %d', server.id())
-                        server.setAuthenticator(self.auth)
-                        
-            except (Murmur.InvalidSecretException, Ice.UnknownUserException, Ice.ConnectionRefusedException) as e:
-                if isinstance(e, Ice.ConnectionRefusedException):
-                    error('Server refused connection')
-                elif isinstance(e, Murmur.InvalidSecretException) or \
-                     isinstance(e, Ice.UnknownUserException) and (e.unknown == 'Murmur::InvalidSecretException'):
-                    error('Invalid ice secret')
+                # Not critical, servers without paging just send everything at once
+                control = SimplePagedResultsControl(False, size = cfg.ldap.page_size, cookie = '')
+                while True:
+                    msgid = con.search_ext(base, scope, filterstr, attrlist, serverctrls = [control])
+                    rtype, rdata, rmsgid, serverctrls = con.result3(msgid)
+                    spent, start = spent + time.time() - start, None
+                    for dn, attrs in rdata:
+                        if dn is not None: # Skip search continuation references
+                            yield (dn, attrs)
+                    start = time.time()
+
+                    cookie = None
+                    for ctrl in serverctrls:
+                        if ctrl.controlType == SimplePagedResultsControl.controlType:
+                            cookie = ctrl.cookie
+                    if not cookie:
+                        break
+                    control.cookie = cookie
+                complete = True
+            except (ldap.SERVER_DOWN, ldap.CONNECT_ERROR, ldap.TIMEOUT) as e:
+                error('LDAP connection error: %s', str(e))
+                raise threadLdapException()
+            finally:
+                if complete:
+                    cls.checkin(con)
                 else:
-                    # We do not actually want to handle this one, re-raise it
-                    raise e
-                
-                self.connected = False
+                    # Errors or an abandoned iteration may leave a paged search
+                    # open on the server, do not reuse that connection
+                    cls.discard(con)
+        finally:
+            if start is not None:
+                spent += time.time() - start
+            call_stats.stage('ldap_search', spent)
+            cls.end_operation()
+    search_paged = classmethod(search_paged)
+
+    def check_credentials(cls, dn, password):
+        """
+        Verifies a user's password with a bind on a separate, short-lived
+        connection so the pooled ones keep their service identity.
+        """
+        cls.count('user_binds')
+
+        cls.begin_operation()
+        start = time.time()
+        try:
+            con = cls.initialize()
+            try:
+                con.simple_bind_s(dn, password)
+                return True
+            except ldap.INVALID_CREDENTIALS:
                 return False
+            except ldap.TIMEOUT:
+                cls.count('op_timeouts')
+                error('LDAP bind timed out after %ds', cfg.ldap.op_timeout)
+                raise threadLdapException()
+            except ldap.LDAPError as e:
+                error('Could not bind to LDAP server: %s', str(e))
+                raise threadLdapException()
+            finally:
+                cls.close(con)
+        finally:
+            call_stats.stage('ldap_bind', time.time() - start)
+            cls.end_operation()
+    check_credentials = classmethod(check_credentials)
 
-            self.connected = True
-            return True
-        
-        def checkConnection(self):
-            """
-            Tries reapplies all callbacks to make sure the authenticator
-            survives server restarts and disconnects.
-            """
-            #debug('Watchdog run')
+    def disconnect(cls):
+        for mux in cls.multiplexed:
+            mux.close()
+        super(threadLDAP, cls).disconnect()
 
+        stats = cls.statistics()
+        info('LDAP operations: %d user binds, %d timed out, %d refused over the max_operations limit',
+             stats['user_binds'], stats['op_timeouts'], stats['throttled'])
+    disconnect = classmethod(disconnect)
+
+class pendingSearch(object):
+    """
+    Collects the results of one search in flight on a multiplexed connection
+    """
+
+    def __init__(self):
+        self.done = Event()
+        self.entries = []
+        self.error = None
+
+class multiplexedLDAP(object):
+    """
+    Connection bound like the pooled ones that carries many searches at
+    once. Searches are sent with python-ldap's asynchronous message id API
+    and a reader thread hands each result to the thread waiting for it.
+    """
+
+    # python-ldap serializes the calls on a connection, so the reader only
+    # blocks for short polls to let new searches through
+    poll = 0.02
+
+    def __init__(self, name):
+        self.lock = Condition()
+        self.con = None
+        self.pending = {} # message id -> pendingSearch
+
+        self.reader = Thread(target = self.work, name = name)
+        self.reader.daemon = True
+        self.reader.start()
+
+    def search(self, base, scope, filterstr, attrlist = None, retry = True):
+        """
+        Sends a search and waits up to op_timeout seconds for its results.
+        Timed out searches are abandoned, searches lost with the connection
+        are retried once on a new one.
+        """
+        op = pendingSearch()
+        self.lock.acquire()
+        try:
+            if self.con is None:
+                self.con = threadLDAP.connect()
+            con = self.con
+            try:
+                msgid = con.search_ext(base, scope, filterstr, attrlist)
+            except (ldap.SERVER_DOWN, ldap.CONNECT_ERROR, ldap.TIMEOUT) as e:
+                self.fail(con, e)
+                op.error = e
+            else:
+                self.pending[msgid] = op
+                self.lock.notify()
+        finally:
+            self.lock.release()
+
+        if op.error is None and not op.done.wait(cfg.ldap.op_timeout if cfg.ldap.op_timeout > 0 else None):
+            self.lock.acquire()
             try:
-                if not self.attachCallbacks(quiet = not self.failedWatch):
-                    self.failedWatch = True
+                abandon = self.pending.pop(msgid, None) is not None
+            finally:
+                self.lock.release()
+
+            if abandon:
+                threadLDAP.count('op_timeouts')
+                error('LDAP search timed out after %ds', cfg.ldap.op_timeout)
+                try:
+                    con.abandon(msgid)
+                except ldap.LDAPError:
+                    pass
+                raise threadLdapException()
+            # Otherwise the results arrived just now
+
+        if isinstance(op.error, (ldap.SERVER_DOWN, ldap.CONNECT_ERROR, ldap.TIMEOUT)):
+            error('LDAP connection error: %s', str(op.error))
+            if retry:
+                # Make sure we only retry once
+                info('Retrying LDAP operation')
+                return self.search(base, scope, filterstr, attrlist, retry = False)
+            error('LDAP operation failed ultimately')
+            raise threadLdapException()
+        elif op.error is not None:
+            raise op.error
+        return op.entries
+
+    def deliver(self, rtype, rdata, msgid):
+        self.lock.acquire()
+        try:
+            op = self.pending.get(msgid)
+            if op is None:
+                return # Abandoned after a timeout
+            if rtype == ldap.RES_SEARCH_ENTRY:
+                op.entries.extend(rdata)
+            elif rtype == ldap.RES_SEARCH_RESULT:
+                del self.pending[msgid]
+                op.done.set()
+        finally:
+            self.lock.release()
+
+    def finish(self, msgid, e):
+        """
+        Fails a single search the server answered with an error
+        """
+        self.lock.acquire()
+        try:
+            op = self.pending.pop(msgid, None)
+            if op is not None:
+                op.error = e
+                op.done.set()
+        finally:
+            self.lock.release()
+
+    def fail(self, con, e):
+        """
+        Drops a broken connection and fails all searches in flight on it
+        """
+        self.lock.acquire()
+        try:
+            if self.con is not con:
+                return # Already replaced
+            self.con = None
+            for op in self.pending.values():
+                op.error = e
+                op.done.set()
+            self.pending.clear()
+        finally:
+            self.lock.release()
+        debug('Invalidate multiplexed connection to LDAP server')
+        threadLDAP.close(con)
+
+    def close(self):
+        con = self.con
+        if con is not None:
+            self.fail(con, threadLdapException())
+
+    def work(self):
+        while True:
+            self.lock.acquire()
+            try:
+                while not self.pending:
+                    self.lock.wait()
+                con = self.con
+            finally:
+                self.lock.release()
+
+            try:
+                rtype, rdata, msgid, serverctrls = con.result3(ldap.RES_ANY, 0, self.poll)
+            except ldap.TIMEOUT:
+                continue
+            except (ldap.SERVER_DOWN, ldap.CONNECT_ERROR) as e:
+                self.fail(con, e)
+                continue
+            except ldap.LDAPError as e:
+                # Results with an error code raise, they name the search in msgid
+                details = e.args[0] if e.args and isinstance(e.args[0], dict) else {}
+                if 'msgid' in details:
+                    self.finish(details['msgid'], e)
                 else:
-                    self.failedWatch = False
-            except Ice.Exception as e:
-                error('Failed connection check, will retry in next watchdog run (%ds)', cfg.ice.watchdog)
-                debug(str(e))
-                self.failedWatch = True
-
-            # Renew the timer
-            self.watchdog = Timer(cfg.ice.watchdog, self.checkConnection)
-            self.watchdog.start()
-        
-    def checkSecret(func):
+                    self.fail(con, e)
+                continue
+            self.deliver(rtype, rdata, msgid)
+
+def normalize_dn(dn):
+    """
+    Canonical form of a DN for comparisons, case and whitespace around
+    the separators do not matter
+    """
+    dn = dn.lower()
+    try:
+        return ldap.dn.dn2str(ldap.dn.str2dn(dn))
+    except ldap.DECODING_ERROR:
+        return dn
+
+def in_subtree(dn, base):
+    """
+    True if the normalized dn is base itself or an entry below it
+    """
+    return dn == base or dn.endswith(',' + base)
+
+class groupIndex(object):
+    """
+    Set of all member DNs of the groups below group_dn, reloaded in the
+    background every refresh seconds
+    """
+
+    def __init__(self, refresh):
+        self.refresh = refresh
+        self.lock = Lock()
+        self.members = None # None until the first load finished
+
+        worker = Thread(target = self.work, name = 'GroupIndex')
+        worker.daemon = True
+        worker.start()
+
+    def reload(self):
+        start = time.time()
+        members = set()
+        for dn, attrs in threadLDAP.search_paged(cfg.ldap.group_dn, ldap.SCOPE_SUBTREE, '(%s=*)' % cfg.ldap.group_attr, [cfg.ldap.group_attr]):
+            for member in attrs.get(cfg.ldap.group_attr, []):
+                members.add(normalize_dn(member.decode()))
+
+        self.lock.acquire()
+        try:
+            self.members = members
+        finally:
+            self.lock.release()
+        debug('Loaded %d group members in %.1fs', len(members), time.time() - start)
+
+    def contains(self, dn):
         """
-        Decorator that checks whether the server transmitted the right secret
-        if a secret is supposed to be used.
+        True if dn is known to be a member, None while the index is not
+        loaded yet
         """
-        if not cfg.ice.secret:
-            return func
-        
-        def newfunc(*args, **kws):
-            if 'current' in kws:
-                current = kws["current"]
-            else:
-                current = args[-1]
-            
-            if not current or 'secret' not in current.ctx or current.ctx['secret'] != cfg.ice.secret:
-                error('Server transmitted invalid secret. Possible injection attempt.')
-                raise Murmur.InvalidSecretException()
-            
-            return func(*args, **kws)
-        
-        return newfunc
-
-    def fortifyIceFu(retval = None, exceptions = (Ice.Exception,)):
+        self.lock.acquire()
+        try:
+            if self.members is None:
+                return None
+            return normalize_dn(dn) in self.members
+        finally:
+            self.lock.release()
+
+    def work(self):
+        while True:
+            try:
+                self.reload()
+            except threadLdapException:
+                warning('Could not refresh the group index, keeping the old one')
+            except Exception as e:
+                error('Unexpected error while refreshing the group index: %s', str(e))
+            time.sleep(self.refresh)
+
+class userSnapshot(object):
+    """
+    Local copy of the registered users in the directory. Entries modified
+    since the last run are fetched every refresh seconds and the whole
+    list is reloaded every full_refresh seconds to drop deleted users.
+    """
+
+    def __init__(self, refresh, full_refresh):
+        self.refresh = refresh
+        self.full_refresh = full_refresh
+        self.lock = Lock()
+        self.users = None # uid -> name, None until the first load finished
+        self.trigrams = trigramIndex() # uids by the trigrams of their lower case name
+        self.stamp = None # Newest modifyTimestamp seen
+        self.loaded = 0
+
+        worker = Thread(target = self.work, name = 'UserSnapshot')
+        worker.daemon = True
+        worker.start()
+
+    def fetch(self, since = None):
         """
-        Decorator that catches exceptions,logs them and returns a safe retval
-        value. This helps preventing the authenticator getting stuck in
-        critical code paths. Only exceptions that are instances of classes
-        given in the exceptions list are not caught.
-        
-        The default is to catch all non-Ice exceptions.
+        Returns the users modified since the given directory timestamp
+        (all of them without one) and the newest timestamp among them
         """
-        def newdec(func):
-            def newfunc(*args, **kws):
-                try:
-                    return func(*args, **kws)
-                except Exception as e:
-                    catch = True
-                    for ex in exceptions:
-                        if isinstance(e, ex):
-                            catch = False
-                            break
-
-                    if catch:
-                        critical('Unexpected exception caught')
-                        exception(e)
-                        return retval
-                    raise
+        if since:
+            filterstr = '(&(uid=*)(modifyTimestamp>=%s))' % since
+        else:
+            filterstr = '(uid=*)'
 
-            return newfunc
-        return newdec
-                
-    class metaCallback(Murmur.MetaCallback):
-        def __init__(self, app):
-            Murmur.MetaCallback.__init__(self)
-            self.app = app
-
-        @fortifyIceFu()
-        @checkSecret
-        def started(self, server, current = None):
-            """
-            This function is called when a virtual server is started
-            and makes sure an authenticator gets attached if needed.
-            """
-            if not cfg.murmur.servers or server.id() in cfg.murmur.servers:
-                info('Setting authenticator for virtual server %d', server.id())
-                try:
-                    server.setAuthenticator(app.auth)
-                # Apparently this server was restarted without us noticing
-                except (Murmur.InvalidSecretException, Ice.UnknownUserException) as e:
-                    if hasattr(e, "unknown") and e.unknown != "Murmur::InvalidSecretException":
-                        # Special handling for Murmur 1.2.2 servers with invalid slice files
-                        raise e
-                    
-                    error('Invalid ice secret')
-                    return
+        users = {}
+        stamp = since
+        for dn, attrs in threadLDAP.search_paged(cfg.ldap.users_dn, ldap.SCOPE_SUBTREE, filterstr,
+                                                 [cfg.ldap.number_attr, cfg.ldap.display_attr, 'modifyTimestamp']):
+            if cfg.ldap.number_attr in attrs and cfg.ldap.display_attr in attrs:
+                users[int(attrs[cfg.ldap.number_attr][0])] = attrs[cfg.ldap.display_attr][0].decode()
+            if 'modifyTimestamp' in attrs:
+                modified = attrs['modifyTimestamp'][0].decode()
+                if not stamp or modified > stamp:
+                    stamp = modified
+        return users, stamp
+
+    def reload(self):
+        start = time.time()
+        users, stamp = self.fetch()
+        grams = trigramIndex()
+        for uid, name in users.items():
+            grams.add(uid, name.lower())
+
+        self.lock.acquire()
+        try:
+            self.users = users
+            self.trigrams = grams
+            self.stamp = stamp
+            self.loaded = start
+        finally:
+            self.lock.release()
+        info('Loaded snapshot of %d directory users in %.1fs', len(users), time.time() - start)
+
+    def update(self):
+        changes, stamp = self.fetch(self.stamp)
+
+        self.lock.acquire()
+        try:
+            # Renamed users replace their old entry, ids only ever move on a full reload
+            for uid, name in changes.items():
+                if uid in self.users:
+                    self.trigrams.remove(uid, self.users[uid].lower())
+                self.trigrams.add(uid, name.lower())
+            self.users.update(changes)
+            self.stamp = stamp
+        finally:
+            self.lock.release()
+        if changes:
+            debug('Updated %d users in the directory snapshot', len(changes))
+
+    def filter(self, substring, limit = 0):
+        """
+        Returns the users (by LDAP id) whose name contains substring,
+        ignoring case, or None while no snapshot is available. At most
+        limit users, the first ones by name, are returned if it is positive.
+        """
+        self.lock.acquire()
+        try:
+            if self.users is None:
+                return None
+            if not substring:
+                users = list(self.users.items())
             else:
-                debug('Virtual server %d got started', server.id())
-
-        @fortifyIceFu()
-        @checkSecret
-        def stopped(self, server, current = None):
-            """
-            This function is called when a virtual server is stopped
-            """
-            if self.app.connected:
-                # Only try to output the server id if we think we are still connected to prevent
-                # flooding of our thread pool
+                substring = substring.lower()
+                candidates = self.trigrams.candidates([substring])
+                if candidates is None:
+                    # Too short for a trigram, look at every name
+                    candidates = self.users.keys()
+                users = [(uid, self.users[uid]) for uid in candidates if substring in self.users[uid].lower()]
+        finally:
+            self.lock.release()
+
+        if limit > 0 and len(users) > limit:
+            users.sort(key = lambda user: user[1].lower())
+            users = users[:limit]
+        return dict(users)
+
+    def work(self):
+        while True:
+            try:
+                if self.users is None or time.time() - self.loaded >= self.full_refresh:
+                    self.reload()
+                else:
+                    self.update()
+            except threadLdapException:
+                warning('Could not refresh the directory snapshot, keeping the old one')
+            except Exception as e:
+                error('Unexpected error while refreshing the directory snapshot: %s', str(e))
+            time.sleep(self.refresh)
+
+def do_main_program():
+    #
+    #--- Authenticator implementation
+    #    All of this has to go in here so we can correctly daemonize the tool
+    #    without loosing the file descriptors opened by the Ice module
+    def make_authenticator(M, fortifyIceFu, checkSecret):
+        if cfg.user.reject_on_error: # Python 2.4 compat
+            authenticateFortifyResult = (-1, None, None)
+        else:
+            authenticateFortifyResult = (-2, None, None)
+
+        class LDAPAuthenticator(M.ServerUpdatingAuthenticator):
+            def __init__(self):
+                M.ServerUpdatingAuthenticator.__init__(self)
+                self.name_uid_cache = nameCache(cfg.user.name_cache_size, cfg.user.name_cache_ttl)
+                self.unknown_names = negativeCache(cfg.user.unknown_cache_size, cfg.user.unknown_cache_ttl,
+                                                   cfg.user.unknown_query_interval)
+
+                self.groups = None
+                self.snapshot = None
+
+            def start(self):
+                """
+                Opens the pooled connections, then starts the background loads
+                """
+                threadLDAP.start()
+
+                if cfg.ldap.group_dn and cfg.ldap.group_membership == 'index':
+                    self.groups = groupIndex(cfg.ldap.group_refresh)
+
+                if cfg.ldap.provide_users and cfg.ldap.users_snapshot:
+                    self.snapshot = userSnapshot(cfg.ldap.snapshot_refresh, cfg.ldap.snapshot_full_refresh)
+
+            def stop(self):
+                threadLDAP.disconnect()
+
+            @fortifyIceFu(authenticateFortifyResult)
+            @checkSecret
+            def authenticate(self, name, pw, certlist, certhash, strong, current = None):
+                """
+                This function is called to authenticate a user
+                """
+
+                # Search for the user in the database
+                FALL_THROUGH = -2
+                AUTH_REFUSED = -1
+
+                # SuperUser is a special login.
+                if name == 'SuperUser':
+                    debug('Forced fall through for SuperUser')
+                    return (FALL_THROUGH, None, None)
+
+                # Otherwise, let's check the LDAP server.
+                uid = None
+                ldap_conn = None
+                operation = False
+
                 try:
-                    if not cfg.murmur.servers or server.id() in cfg.murmur.servers:
-                        info('Authenticated virtual server %d got stopped', server.id())
+                    if cfg.ldap.bind_dn or cfg.ldap.discover_dn:
+                        # Search with the pooled connections bound to bind_dn or
+                        # anonymously, the password is checked with its own bind below
+                        search = threadLDAP.search
                     else:
-                        debug('Virtual server %d got stopped', server.id())
-                    return
-                except Ice.ConnectionRefusedException:
-                    self.app.connected = False
-            
-            debug('Server shutdown stopped a virtual server')
-    
-    if cfg.user.reject_on_error: # Python 2.4 compat
-        authenticateFortifyResult = (-1, None, None)
-    else:
-        authenticateFortifyResult = (-2, None, None)
-        
-    class LDAPAuthenticator(Murmur.ServerUpdatingAuthenticator):
-        def __init__(self):
-            Murmur.ServerUpdatingAuthenticator.__init__(self)
-            self.name_uid_cache = dict()
-
-        @fortifyIceFu(authenticateFortifyResult)
-        @checkSecret
-        def authenticate(self, name, pw, certlist, certhash, strong, current = None):
-            """
-            This function is called to authenticate a user
-            """
-            
-            # Search for the user in the database
-            FALL_THROUGH = -2
-            AUTH_REFUSED = -1
-            
-            # SuperUser is a special login.
-            if name == 'SuperUser':
-                debug('Forced fall through for SuperUser')
-                return (FALL_THROUGH, None, None)
-
-            # Otherwise, let's check the LDAP server.
-            uid = None
-
-            if cfg.ldap.use_start_tls:
-                # try StartTLS: global options
-                debug('use_start_tls is set, setting global option TLS_REQCERT = never')
-                ldap.set_option(ldap.OPT_X_TLS_REQUIRE_CERT, ldap.OPT_X_TLS_NEVER)
-
-            ldap_trace = 0 # Change to 1 for more verbose trace
-            ldap_conn = ldap.initialize(cfg.ldap.ldap_uri, ldap_trace)
-
-            if cfg.ldap.use_start_tls:
-                # try StartTLS: connection specific options
-                debug('use_start_tls is set, setting connection options X_TLS_*')
-                ldap_conn.set_option(ldap.OPT_PROTOCOL_VERSION, 3)
-                ldap_conn.set_option(ldap.OPT_X_TLS, ldap.OPT_X_TLS_DEMAND)
-                ldap_conn.set_option(ldap.OPT_X_TLS_DEMAND, True)
-                try:
-                    ldap_conn.start_tls_s()
-                except Exception as e:
-                    warning('could not initiate StartTLS, e = ' + str(e))
-                    return (AUTH_REFUSED, None, None)
+                        # Prevent anonymous authentication.
+                        if not pw:
+                            warning("No password supplied for user " + name)
+                            return (AUTH_REFUSED, None, None)
 
-            if cfg.ldap.bind_dn:
-                # Bind the functional account to search the directory.
-                bind_dn = cfg.ldap.bind_dn
-                bind_pass = cfg.ldap.bind_pass
-                try:
-                    debug('try to connect to ldap (bind_dn will be used)')
-                    ldap_conn.bind_s(bind_dn, bind_pass)
-                except ldap.INVALID_CREDENTIALS: 
-                    ldap_conn.unbind()
-                    warning('Invalid credentials for bind_dn=' + bind_dn)
-                    return (AUTH_REFUSED, None, None)
-            elif cfg.ldap.discover_dn:
-                # Use anonymous bind to discover the DN
-                try:
-                    ldap_conn.bind_s()
-                except ldap.INVALID_CREDENTIALS: 
-                    ldap_conn.unbind()
-                    warning('Failed anomymous bind for discovering DN')
-                    return (AUTH_REFUSED, None, None)
+                        # Bind the user account to search the directory.
+                        bind_dn = "%s=%s,%s" % (cfg.ldap.username_attr, name, cfg.ldap.users_dn)
+                        threadLDAP.begin_operation()
+                        operation = True
+                        ldap_conn = threadLDAP.initialize()
+                        try:
+                            ldap_conn.simple_bind_s(bind_dn, pw)
+                        except ldap.INVALID_CREDENTIALS:
+                            warning('User ' + name + ' failed with invalid credentials')
+                            return (AUTH_REFUSED, None, None)
+                        search = ldap_conn.search_s
+
+                    # Search for the user.
+                    attrs = [cfg.ldap.number_attr, cfg.ldap.display_attr]
+                    if cfg.ldap.group_membership == 'memberof':
+                        attrs.append(cfg.ldap.memberof_attr)
+                    res = search(cfg.ldap.users_dn, ldap.SCOPE_SUBTREE, '(%s=%s)' % (cfg.ldap.username_attr, name), attrs)
+                    if len(res) == 0:
+                        warning("User " + name + " not found")
+                        if cfg.user.reject_on_miss:
+                            return (AUTH_REFUSED, None, None)
+                        else:
+                            return (FALL_THROUGH, None, None)
+                    match = res[0] #Only interested in the first result, as there should only be one match
+
+                    # Parse the user information.
+                    uid = int(match[1][cfg.ldap.number_attr][0])
+                    displayName = match[1][cfg.ldap.display_attr][0].decode()
+                    user_dn = match[0]
+                    debug('User match found, display "' + displayName + '" with UID ' + repr(uid))
+
+                    # Optionally check groups.
+                    if cfg.ldap.group_dn != "" :
+                        debug('Checking group membership for ' + name)
+
+                        if cfg.ldap.group_membership == 'memberof':
+                            # The directory already told us in the user entry
+                            group_dn = normalize_dn(cfg.ldap.group_dn)
+                            member = False
+                            for group in match[1].get(cfg.ldap.memberof_attr, []):
+                                if in_subtree(normalize_dn(group.decode()), group_dn):
+                                    member = True
+                                    break
+                        else:
+                            member = self.groups and self.groups.contains(user_dn)
+                            if not member:
+                                # Not in the index (or no index), users added since its last
+                                # refresh must not be refused so ask the directory
+                                res = search(cfg.ldap.group_dn, ldap.SCOPE_SUBTREE, '(%s=%s)' % (cfg.ldap.group_attr, user_dn), [cfg.ldap.number_attr, cfg.ldap.display_attr])
+                                member = len(res) > 0
+
+                        # Check if the user is a member of the group
+                        if not member:
+                            debug('User ' + name + ' failed with no group membership')
+                            return (AUTH_REFUSED, None, None)
+
+                    # Second bind to test user credentials if using bind_dn or discover_dn.
+                    if cfg.ldap.bind_dn or cfg.ldap.discover_dn:
+                        # Prevent anonymous authentication.
+                        if not pw:
+                            warning("No password supplied for user " + name)
+                            return (AUTH_REFUSED, None, None)
+
+                        if not threadLDAP.check_credentials(user_dn, pw):
+                            warning('User ' + name + ' failed with wrong password')
+                            return (AUTH_REFUSED, None, None)
+                except ldap.TIMEOUT:
+                    threadLDAP.count('op_timeouts')
+                    error('LDAP operation for user %s timed out after %ds', name, cfg.ldap.op_timeout)
+                    # Only wrong credentials refuse, errors follow reject_on_error
+                    return authenticateFortifyResult
+                except threadLdapException:
+                    return authenticateFortifyResult
+                finally:
+                    if ldap_conn:
+                        # Unbind and close connection.
+                        threadLDAP.close(ldap_conn)
+                    if operation:
+                        threadLDAP.end_operation()
+
+                # If we get here, the login is correct.
+                # Add the user/id combo to cache, then accept:
+                self.name_uid_cache.put(displayName, uid)
+                self.unknown_names.found(displayName)
+                debug("Login accepted for " + name)
+                return (uid + cfg.user.id_offset, displayName, [])
+
+            @fortifyIceFu((False, None))
+            @checkSecret
+            def getInfo(self, id, current = None):
+                """
+                Gets called to fetch user specific information
+                """
+
+                if not cfg.ldap.provide_info:
+                    # We do not expose any additional information so always fall through
+                    debug('getInfo for %d -> denied', id)
+                    return (False, None)
+
+                name = self.idToName(id, current)
 
-            else:
-                # Prevent anonymous authentication.
-                if not pw:
-                    warning("No password supplied for user " + name)
-                    return (AUTH_REFUSED, None, None)
-            
-                # Bind the user account to search the directory.
-                bind_dn = "%s=%s,%s" % (cfg.ldap.username_attr, name, cfg.ldap.users_dn)
-                bind_pass = pw
                 try:
-                    ldap_conn.bind_s(bind_dn, bind_pass)
-                except ldap.INVALID_CREDENTIALS: 
-                    ldap_conn.unbind()
-                    warning('User ' + name + ' failed with invalid credentials')
-                    return (AUTH_REFUSED, None, None)
-
-            # Search for the user.
-            res = ldap_conn.search_s(cfg.ldap.users_dn, ldap.SCOPE_SUBTREE, '(%s=%s)' % (cfg.ldap.username_attr, name), [cfg.ldap.number_attr, cfg.ldap.display_attr])
-            if len(res) == 0:
-                warning("User " + name + " not found")
-                if cfg.user.reject_on_miss:
-                    return (AUTH_REFUSED, None, None)
+                    res = threadLDAP.search(cfg.ldap.users_dn,
+                                            ldap.SCOPE_SUBTREE,
+                                            '(%s=%s)' % (cfg.ldap.display_attr, name),
+                                            [cfg.ldap.display_attr,
+                                             cfg.ldap.mail_attr
+                                            ])
+                except threadLdapException:
+                    return (False, None)
+
+                #If user found, return info
+                if len(res) == 1:
+                    info = {}
+
+                    if cfg.ldap.mail_attr in res[0][1]:
+                        info[M.UserInfo.UserEmail] = res[0][1][cfg.ldap.mail_attr][0].decode()
+
+                    debug('getInfo %s -> %s', name, repr(info))
+                    return (True, info)
                 else:
-                    return (FALL_THROUGH, None, None)
-            match = res[0] #Only interested in the first result, as there should only be one match
-                
-            # Parse the user information.
-            uid = int(match[1][cfg.ldap.number_attr][0])
-            displayName = match[1][cfg.ldap.display_attr][0].decode()
-            user_dn = match[0]
-            debug('User match found, display "' + displayName + '" with UID ' + repr(uid))
-                
-            # Optionally check groups.
-            if cfg.ldap.group_dn != "" :
-                debug('Checking group membership for ' + name)
-                    
-                #Search for user in group
-                res = ldap_conn.search_s(cfg.ldap.group_dn, ldap.SCOPE_SUBTREE, '(%s=%s)' % (cfg.ldap.group_attr, user_dn), [cfg.ldap.number_attr, cfg.ldap.display_attr])
-                    
-                # Check if the user is a member of the group
-                if len(res) < 1:
-                    debug('User ' + name + ' failed with no group membership')
-                    return (AUTH_REFUSED, None, None)
-                    
-            # Second bind to test user credentials if using bind_dn or discover_dn.
-            if cfg.ldap.bind_dn or cfg.ldap.discover_dn:
-                # Prevent anonymous authentication.
-                if not pw:
-                    warning("No password supplied for user " + name)
-                    return (AUTH_REFUSED, None, None)
-            
-                bind_dn = user_dn
-                bind_pass = pw
+                    debug('getInfo %s -> ?', name)
+                    return (False, None)
+
+
+
+            @fortifyIceFu(-2)
+            @checkSecret
+            def nameToId(self, name, current = None):
+                """
+                Gets called to get the id for a given username
+                """
+                FALL_THROUGH = -2
+
+                if name == 'SuperUser':
+                    debug('nameToId SuperUser -> forced fall through')
+                    return FALL_THROUGH
+
+                uid = self.name_uid_cache.uid(name)
+                if uid is not None:
+                    uid = uid + cfg.user.id_offset
+                    debug("nameToId %s (cache) -> %d", name, uid)
+                    return uid
+
+                if self.unknown_names.skip(name):
+                    debug('nameToId %s -> ? (cached)', name)
+                    return FALL_THROUGH
+
                 try:
-                    ldap_conn.bind_s(bind_dn, bind_pass)
-                except ldap.INVALID_CREDENTIALS: 
-                    ldap_conn.unbind()
-                    warning('User ' + name + ' failed with wrong password')
-                    return (AUTH_REFUSED, None, None)
-
-            # Unbind and close connection.
-            ldap_conn.unbind()
-                
-            # If we get here, the login is correct.
-            # Add the user/id combo to cache, then accept:
-            self.name_uid_cache[displayName] = uid
-            debug("Login accepted for " + name)
-            return (uid + cfg.user.id_offset, displayName, [])
-            
-        @fortifyIceFu((False, None))
-        @checkSecret
-        def getInfo(self, id, current = None):
-            """
-            Gets called to fetch user specific information
-            """
-            
-            if not cfg.ldap.provide_info:
-                # We do not expose any additional information so always fall through
-                debug('getInfo for %d -> denied', id)
-                return (False, None)
-
-            ldap_conn = ldap.initialize(cfg.ldap.ldap_uri, 0)
-
-            # Bind if configured, else do explicit anonymous bind
-            if cfg.ldap.bind_dn and cfg.ldap.bind_pass:
-                ldap_conn.simple_bind_s(cfg.ldap.bind_dn, cfg.ldap.bind_pass)
-            else:
-                ldap_conn.simple_bind_s()
-
-            name = self.idToName(id, current)
-
-            res = ldap_conn.search_s(cfg.ldap.users_dn,
-                                    ldap.SCOPE_SUBTREE,
-                                    '(%s=%s)' % (cfg.ldap.display_attr, name),
-                                    [cfg.ldap.display_attr,
-                                     cfg.ldap.mail_attr    
-                                    ])
-            
-            #If user found, return info
-            if len(res) == 1:
-                info = {}
-
-                if cfg.ldap.mail_attr in res[0][1]:
-                    info[Murmur.UserInfo.UserEmail] = res[0][1][cfg.ldap.mail_attr][0].decode()
-
-                debug('getInfo %s -> %s', name, repr(info))
-                return (True, info)
-            else:
-                debug('getInfo %s -> ?', name)
-                return (False, None)
-
-
-    
-        @fortifyIceFu(-2)
-        @checkSecret
-        def nameToId(self, name, current = None):
-            """
-            Gets called to get the id for a given username
-            """
-            FALL_THROUGH = -2
-            
-            if name == 'SuperUser':
-                debug('nameToId SuperUser -> forced fall through')
-                return FALL_THROUGH
-            
-            if name in self.name_uid_cache:
-                uid = self.name_uid_cache[name] + cfg.user.id_offset
-                debug("nameToId %s (cache) -> %d", name, uid)
+                    res = threadLDAP.search(cfg.ldap.users_dn, ldap.SCOPE_SUBTREE, '(%s=%s)' % (cfg.ldap.display_attr, name), [cfg.ldap.number_attr])
+                except threadLdapException:
+                    self.unknown_names.release(name)
+                    return FALL_THROUGH
+                except:
+                    # Waiting lookups of the name have to query themselves
+                    self.unknown_names.release(name)
+                    raise
+
+                #If user found, return the ID
+                if len(res) == 1:
+                    uid = int(res[0][1][cfg.ldap.number_attr][0])
+                    self.name_uid_cache.put(name, uid)
+                    self.unknown_names.found(name)
+                    uid = uid + cfg.user.id_offset
+                    debug('nameToId %s -> %d', name, uid)
+                else:
+                    if not res:
+                        self.unknown_names.missing(name)
+                    else:
+                        self.unknown_names.release(name)
+                    debug('nameToId %s -> ?', name)
+                    return FALL_THROUGH
+
                 return uid
-            
-            ldap_conn = ldap.initialize(cfg.ldap.ldap_uri, 0)
 
-            # Bind if configured, else do explicit anonymous bind
-            if cfg.ldap.bind_dn and cfg.ldap.bind_pass:
-                ldap_conn.simple_bind_s(cfg.ldap.bind_dn, cfg.ldap.bind_pass)
-            else:
-                ldap_conn.simple_bind_s()
-
-            res = ldap_conn.search_s(cfg.ldap.users_dn, ldap.SCOPE_SUBTREE, '(%s=%s)' % (cfg.ldap.display_attr, name), [cfg.ldap.number_attr])
-            
-            #If user found, return the ID
-            if len(res) == 1:
-                uid = int(res[0][1][cfg.ldap.number_attr][0]) + cfg.user.id_offset
-                debug('nameToId %s -> %d', name, uid)
-            else:
-                debug('nameToId %s -> ?', name)
-                return FALL_THROUGH
-            
-            return uid
-        
-        
-        @fortifyIceFu("")
-        @checkSecret
-        def idToName(self, id, current = None):
-            """
-            Gets called to get the username for a given id
-            """
-            
-            FALL_THROUGH = ""
-
-            # Make sure the ID is in our range and transform it to the actual LDAP user id
-            if id < cfg.user.id_offset:
-                debug('idToName %d -> fall through', id)
-                return FALL_THROUGH 
-            
-            ldapid = id - cfg.user.id_offset
-            
-            for name, uid in self.name_uid_cache.items():
-                if uid == ldapid:
-                    if name == 'SuperUser':
-                        debug('idToName %d -> "SuperUser" catched', id)
+
+            @fortifyIceFu("")
+            @checkSecret
+            def idToName(self, id, current = None):
+                """
+                Gets called to get the username for a given id
+                """
+
+                FALL_THROUGH = ""
+
+                # Make sure the ID is in our range and transform it to the actual LDAP user id
+                if id < cfg.user.id_offset:
+                    debug('idToName %d -> fall through', id)
+                    return FALL_THROUGH 
+
+                ldapid = id - cfg.user.id_offset
+
+                name = self.name_uid_cache.name(ldapid)
+                if name is None:
+                    # Not seen since the cache was filled, ask the directory
+                    try:
+                        res = threadLDAP.search(cfg.ldap.users_dn, ldap.SCOPE_SUBTREE, '(%s=%d)' % (cfg.ldap.number_attr, ldapid), [cfg.ldap.display_attr])
+                    except threadLdapException:
+                        return FALL_THROUGH
+
+                    if len(res) != 1 or cfg.ldap.display_attr not in res[0][1]:
+                        debug('idToName %d -> ?', id)
                         return FALL_THROUGH
-                    
-                    debug('idToName %d -> "%s"', id, name)
-                    return name
-                
-            debug('idToName %d -> ?', id)
-            return FALL_THROUGH
-         
-            
-        @fortifyIceFu("")
-        @checkSecret
-        def idToTexture(self, id, current = None):
-            """
-            Gets called to get the corresponding texture for a user
-            """
-            
-            FALL_THROUGH = ""
-            debug('idToTexture %d -> fall through', id)
-            return FALL_THROUGH
-            
-        @fortifyIceFu(-2)
-        @checkSecret
-        def registerUser(self, name, current = None):
-            """
-            Gets called when the server is asked to register a user.
-            """
-            
-            FALL_THROUGH = -2
-            debug('registerUser "%s" -> fall through', name)
-            return FALL_THROUGH
-
-        @fortifyIceFu(-1)
-        @checkSecret
-        def unregisterUser(self, id, current = None):
-            """
-            Gets called when the server is asked to unregister a user.
-            """
-            
-            FALL_THROUGH = -1
-            # Return -1 to fall through to internal server database, we will not modify the LDAP directory
-            # but we can make murmur delete all additional information it got this way.
-            debug('unregisterUser %d -> fall through', id)
-            return FALL_THROUGH
-
-        @fortifyIceFu({})
-        @checkSecret
-        def getRegisteredUsers(self, filter, current = None):
-            """
-            Returns a list of usernames in the LDAP directory which contain
-            filter as a substring.
-            """
-            FALL_THROUGH = {}
-
-            if not cfg.ldap.provide_users:
-                # Fall through if not configured to provide user list
-                debug('getRegisteredUsers -> fall through')
+
+                    name = res[0][1][cfg.ldap.display_attr][0].decode()
+                    self.name_uid_cache.put(name, ldapid)
+
+                if name == 'SuperUser':
+                    debug('idToName %d -> "SuperUser" catched', id)
+                    return FALL_THROUGH
+
+                debug('idToName %d -> "%s"', id, name)
+                return name
+
+
+            @fortifyIceFu("")
+            @checkSecret
+            def idToTexture(self, id, current = None):
+                """
+                Gets called to get the corresponding texture for a user
+                """
+
+                FALL_THROUGH = ""
+                debug('idToTexture %d -> fall through', id)
                 return FALL_THROUGH
 
-            ldap_conn = ldap.initialize(cfg.ldap.ldap_uri, 0)
+            @fortifyIceFu(-2)
+            @checkSecret
+            def registerUser(self, name, current = None):
+                """
+                Gets called when the server is asked to register a user.
+                """
 
-            # Bind if configured, else do explicit anonymous bind
-            if cfg.ldap.bind_dn and cfg.ldap.bind_pass:
-                ldap_conn.simple_bind_s(cfg.ldap.bind_dn, cfg.ldap.bind_pass)
-            else:
-                ldap_conn.simple_bind_s()
+                FALL_THROUGH = -2
+                debug('registerUser "%s" -> fall through', name)
+                return FALL_THROUGH
 
-            if filter:
-                res = ldap_conn.search_s(cfg.ldap.users_dn, ldap.SCOPE_SUBTREE, '(&(uid=*)(%s=*%s*))' % (cfg.ldap.display_attr, filter), [cfg.ldap.number_attr, cfg.ldap.display_attr])
-            else:
-                res = ldap_conn.search_s(cfg.ldap.users_dn, ldap.SCOPE_SUBTREE, '(uid=*)', [cfg.ldap.number_attr, cfg.ldap.display_attr])
-            
-            # Build result dict
-            users = {}
-            for dn, attrs in res:
-                if cfg.ldap.number_attr in attrs and cfg.ldap.display_attr in attrs:
-                    uid = int(attrs[cfg.ldap.number_attr][0]) + cfg.user.id_offset
-                    name = attrs[cfg.ldap.display_attr][0]
-                    users[uid] = name
-            debug('getRegisteredUsers %s -> %s', filter, repr(users))
-            return users
-        
-        @fortifyIceFu(-1)
-        @checkSecret
-        def setInfo(self, id, info, current = None):
-            """
-            Gets called when the server is supposed to save additional information
-            about a user to his database
-            """
-            
-            FALL_THROUGH = -1
-            # Return -1 to fall through to the internal server handler. We do not store
-            # any information in LDAP
-            debug('setInfo %d -> fall through', id)
-            return FALL_THROUGH
-        
-        @fortifyIceFu(-1)
-        @checkSecret
-        def setTexture(self, id, texture, current = None):
-            """
-            Gets called when the server is asked to update the user texture of a user
-            """
-            FALL_THROUGH = -1
-            
-            # We do not store textures in LDAP
-            debug('setTexture %d -> fall through', id)
-            return FALL_THROUGH
-        
-    class CustomLogger(Ice.Logger):
-        """
-        Logger implementation to pipe Ice log messages into
-        out own log
-        """
-        
-        def __init__(self):
-            Ice.Logger.__init__(self)
-            self._log = getLogger('Ice')
-            
-        def _print(self, message):
-            self._log.info(message)
-            
-        def trace(self, category, message):
-            self._log.debug('Trace %s: %s', category, message)
-            
-        def warning(self, message):
-            self._log.warning(message)
-            
-        def error(self, message):
-            self._log.error(message)
+            @fortifyIceFu(-1)
+            @checkSecret
+            def unregisterUser(self, id, current = None):
+                """
+                Gets called when the server is asked to unregister a user.
+                """
 
-    #
-    #--- Start of authenticator
-    #
-    info('Starting LDAP mumble authenticator')
-    initdata = Ice.InitializationData()
-    initdata.properties = Ice.createProperties([], initdata.properties)
-    for prop, val in cfg.iceraw:
-        initdata.properties.setProperty(prop, val)
-        
-    initdata.properties.setProperty('Ice.ImplicitContext', 'Shared')
-    initdata.properties.setProperty('Ice.Default.EncodingVersion', '1.0')
-    initdata.logger = CustomLogger()
-    
-    app = LDAPAuthenticatorApp()
-    state = app.main(sys.argv[:1], initData = initdata)
-    info('Shutdown complete')
+                FALL_THROUGH = -1
+                # Return -1 to fall through to internal server database, we will not modify the LDAP directory
+                # but we can make murmur delete all additional information it got this way.
+                debug('unregisterUser %d -> fall through', id)
+                return FALL_THROUGH
+
+            @fortifyIceFu({})
+            @checkSecret
+            def getRegisteredUsers(self, filter, current = None):
+                """
+                Returns a list of usernames in the LDAP directory which contain
+                filter as a substring.
+                """
+                FALL_THROUGH = {}
+
+                if not cfg.ldap.provide_users:
+                    # Fall through if not configured to provide user list
+                    debug('getRegisteredUsers -> fall through')
+                    return FALL_THROUGH
+
+                if self.snapshot:
+                    snapshot = self.snapshot.filter(filter, cfg.ldap.snapshot_max_results)
+                    if snapshot is not None:
+                        users = dict((uid + cfg.user.id_offset, name) for uid, name in snapshot.items())
+                        debug('getRegisteredUsers %s (snapshot) -> %d users', filter, len(users))
+                        return users
+
+                if filter:
+                    filterstr = '(&(uid=*)(%s=*%s*))' % (cfg.ldap.display_attr, filter)
+                else:
+                    filterstr = '(uid=*)'
+
+                # Build result dict page by page
+                users = {}
+                try:
+                    for dn, attrs in threadLDAP.search_paged(cfg.ldap.users_dn, ldap.SCOPE_SUBTREE, filterstr, [cfg.ldap.number_attr, cfg.ldap.display_attr]):
+                        if cfg.ldap.number_attr in attrs and cfg.ldap.display_attr in attrs:
+                            uid = int(attrs[cfg.ldap.number_attr][0]) + cfg.user.id_offset
+                            name = attrs[cfg.ldap.display_attr][0].decode()
+                            users[uid] = name
+                except threadLdapException:
+                    return FALL_THROUGH
+                debug('getRegisteredUsers %s -> %d users', filter, len(users))
+                return users
+
+            @fortifyIceFu(-1)
+            @checkSecret
+            def setInfo(self, id, info, current = None):
+                """
+                Gets called when the server is supposed to save additional information
+                about a user to his database
+                """
+
+                FALL_THROUGH = -1
+                # Return -1 to fall through to the internal server handler. We do not store
+                # any information in LDAP
+                debug('setInfo %d -> fall through', id)
+                return FALL_THROUGH
+
+            @fortifyIceFu(-1)
+            @checkSecret
+            def setTexture(self, id, texture, current = None):
+                """
+                Gets called when the server is asked to update the user texture of a user
+                """
+                FALL_THROUGH = -1
+
+                # We do not store textures in LDAP
+                debug('setTexture %d -> fall through', id)
+                return FALL_THROUGH
+
+        return LDAPAuthenticator()
+
+    serve('LDAP', 'Murmur', make_authenticator)
 
 #
 #--- Start of program
 #
 if __name__ == '__main__':
-    # Parse commandline options
-    parser = OptionParser()
-    parser.add_option('-i', '--ini',
-                      help = 'load configuration from INI', default = cfgfile)
-    parser.add_option('-v', '--verbose', action='store_true', dest = 'verbose',
-                      help = 'verbose output [default]', default = True)
-    parser.add_option('-q', '--quiet', action='store_false', dest = 'verbose',
-                      help = 'only error output')
-    parser.add_option('-d', '--daemon', action='store_true', dest = 'force_daemon',
-                      help = 'run as daemon', default = False)
-    parser.add_option('-a', '--app', action='store_true', dest = 'force_app',
-                      help = 'do not run as daemon', default = False)
-    (option, args) = parser.parse_args()
-    
-    if option.force_daemon and option.force_app:
-        parser.print_help()
-        sys.exit(1)
-        
-    # Load configuration
-    try:
-        cfg = config(option.ini, default)
-    except Exception as e:
-        print('Fatal error, could not load config file from "%s"' % cfgfile, file=sys.stderr)
-        sys.exit(1)
-    
-    
-    # Initialize logger
-    if cfg.log.file:
-        try:
-            logfile = open(cfg.log.file, 'a')
-        except IOError as e:
-            #print>>sys.stderr, str(e)
-            print('Fatal error, could not open logfile "%s"' % cfg.log.file, file=sys.stderr)
-            sys.exit(1)
-    else:
-        logfile = logging.sys.stderr
-        
-            
-    if option.verbose:
-        level = cfg.log.level
-    else:
-        level = logging.ERROR
-    
-    logging.basicConfig(level = level,
-                        format='%(asctime)s %(levelname)s %(message)s',
-                        stream = logfile)
-        
-    # As the default try to run as daemon. Silently degrade to running as a normal application if this fails
-    # unless the user explicitly defined what he expected with the -a / -d parameter. 
-    try:
-        if option.force_app:
-            raise ImportError # Pretend that we couldn't import the daemon lib
-        import daemon
-    except ImportError:
-        if option.force_daemon:
-            print('Fatal error, could not daemonize process due to missing "daemon" library, ' \
-            'please install the missing dependency and restart the authenticator', file=sys.stderr)
-            sys.exit(1)
-        do_main_program()
-    else:
-        context = daemon.DaemonContext(working_directory = sys.path[0],
-                                       stderr = logfile)
-        context.__enter__()
-        try:
-            do_main_program()
-        finally:
-            context.__exit__(None, None, None)
+    cfg = authcore.setup(cfgfile, default, 'ldapauth')
+    authcore.launch(do_main_program)
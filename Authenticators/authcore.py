@@ -0,0 +1,2805 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+# Copyright (C) 2026 The Mumble Developers
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+# - Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# - Neither the name of the Mumble Developers nor the names of its
+#   contributors may be used to endorse or promote products derived from this
+#   software without specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# `AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL THE FOUNDATION OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+#
+#    authcore.py - Shared core of the Murmur authenticators
+#
+#    Configuration loading, connection pooling, caches, password hash
+#    verification, statistics and the Ice side (connecting to Murmur,
+#    attaching to the virtual servers, reconnecting) live here once for
+#    phpBB3auth.py, smfauth.py (1.x and 2.0), elkarteauth.py and
+#    LDAPauth.py, which only add what is specific to their user database.
+#
+#    The forum authenticators implement a forumBackend (look up a user,
+#    verify a password, fetch the groups and the avatar of a user) and are
+#    served by the generic forumAuthenticator. LDAPauth.py brings its own
+#    servant and only uses the helpers and serve().
+#
+#    The scripts look for this file next to themselves and in the
+#    directories above, keep it in the Authenticators directory or copy it
+#    next to the script when deploying.
+#
+#    Requirements:
+#        * python >=2.7 or >=3.0 and the following python modules:
+#            * ice-python
+#            * daemon (when run as a daemon)
+#            * PIL or Pillow (when avatar_resize is enabled)
+#
+
+import os
+import sys
+import Ice
+import hmac
+import io
+import time
+import re
+import bisect
+import logging
+import multiprocessing
+import signal
+
+from threading  import Condition, Lock, Thread
+from collections import OrderedDict
+from array      import array
+from hashlib    import sha1
+from optparse   import OptionParser
+from logging    import (debug,
+                        info,
+                        warning,
+                        error,
+                        critical,
+                        exception,
+                        getLogger)
+
+try:
+    import configparser
+except ImportError: # python 2
+    import ConfigParser as configparser
+
+try:
+    import queue
+except ImportError: # python 2
+    import Queue as queue
+
+try:
+    from urllib.request import Request, urlopen
+    from urllib.error import URLError, HTTPError
+except ImportError: # python 2
+    from urllib2 import Request, urlopen, URLError, HTTPError
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+except ImportError: # python 2
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+try:
+    string_types = basestring
+except NameError: # python 3
+    string_types = str
+
+try:
+    from PIL import Image
+except ImportError: # Only needed for avatar_resize
+    Image = None
+
+# Set up by setup() from the command line and the configuration file
+cfg = None
+db = None
+options = None
+
+def x2bool(s):
+    """Helper function to convert strings from the config to bool"""
+    if isinstance(s, bool):
+        return s
+    elif isinstance(s, string_types):
+        return s.lower() in ['1', 'true']
+    raise ValueError()
+
+def endpoint_list(s):
+    """
+    Helper function to convert a comma separated list of host:port Ice
+    endpoints from the config to (host, port) tuples
+    """
+    endpoints = []
+    for endpoint in s.split(','):
+        endpoint = endpoint.strip()
+        if not endpoint:
+            continue
+        host, sep, port = endpoint.rpartition(':')
+        if not sep or host.endswith(':'):
+            # No port given, or a bare IPv6 address
+            host, port = endpoint, 6502
+        endpoints.append((host.strip('[]'), int(port)))
+    return endpoints
+
+#
+#--- Helper classes
+#
+class config(object):
+    """
+    Small abstraction for config loading
+    """
+
+    def __init__(self, filename = None, default = None):
+        if not filename or not default: return
+        cfg = configparser.ConfigParser()
+        cfg.optionxform = str
+        cfg.read(filename)
+        
+        for h,v in default.items():
+            if not v:
+                # Output this whole section as a list of raw key/value tuples
+                try:
+                    self.__dict__[h] = cfg.items(h)
+                except configparser.NoSectionError:
+                    self.__dict__[h] = []
+            else:
+                self.__dict__[h] = config()
+                for name, conv, vdefault in v:
+                    try:
+                        self.__dict__[h].__dict__[name] = conv(cfg.get(h, name))
+                    except (ValueError, configparser.NoSectionError, configparser.NoOptionError):
+                        self.__dict__[h].__dict__[name] = vdefault
+                    
+def entity_decode(string):
+    """
+    Python reverse implementation of php htmlspecialchars
+    """
+    htmlspecialchars = (('"', '&quot;'),
+                        ("'", '&#039;'),
+                        ('<', '&lt;'),
+                        ('>', '&gt'),
+                        ('&', '&amp;'))
+    ret = string
+    for (s,t) in htmlspecialchars:
+        ret = ret.replace(t, s)
+    return ret
+
+def entity_encode(string):
+    """
+    Python implementation of htmlspecialchars
+    """
+    htmlspecialchars = (('&', '&amp;'),
+                        ('"', '&quot;'),
+                        ("'", '&#039;'),
+                        ('<', '&lt;'),
+                        ('>', '&gt'))
+    ret = string
+    for (s,t) in htmlspecialchars:
+        ret = ret.replace(s, t)
+    return ret
+        
+class callStatistics(object):
+    """
+    Latency histograms of the Ice callbacks and of the backend stages they
+    spend their time in, the callback counts by outcome and the connection
+    state of every Murmur server. Rendered in the Prometheus text format.
+    """
+
+    buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.lock = Lock()
+        self.calls = {} # method -> histogram
+        self.stages = {} # stage -> histogram
+        self.outcomes = {} # (method, outcome) -> count
+        self.endpoints = {} # host:port -> [connected, reconnects]
+
+    def observe(self, histograms, key, elapsed):
+        """
+        Adds a sample to a histogram, a list of counts per bucket (the last
+        one for slower samples) followed by the sum. Caller must hold the lock.
+        """
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        histogram[bisect.bisect_left(self.buckets, elapsed)] += 1
+        histogram[-1] += elapsed
+
+    def call(self, method, outcome, elapsed):
+        self.lock.acquire()
+        try:
+            self.observe(self.calls, method, elapsed)
+            key = (method, outcome)
+            self.outcomes[key] = self.outcomes.get(key, 0) + 1
+        finally:
+            self.lock.release()
+
+    def stage(self, name, elapsed):
+        self.lock.acquire()
+        try:
+            self.observe(self.stages, name, elapsed)
+        finally:
+            self.lock.release()
+
+    def murmur(self, endpoint, connected, reconnect = False):
+        self.lock.acquire()
+        try:
+            state = self.endpoints.setdefault(endpoint, [False, 0])
+            state[0] = connected
+            if reconnect:
+                state[1] += 1
+        finally:
+            self.lock.release()
+
+    def render_histograms(self, lines, name, label, histograms):
+        for key in sorted(histograms):
+            histogram = histograms[key]
+            count = 0
+            for i in range(len(self.buckets)):
+                count += histogram[i]
+                lines.append('%s_bucket{%s="%s",le="%g"} %d' % (name, label, key, self.buckets[i], count))
+            count += histogram[len(self.buckets)]
+            lines.append('%s_bucket{%s="%s",le="+Inf"} %d' % (name, label, key, count))
+            lines.append('%s_sum{%s="%s"} %f' % (name, label, key, histogram[-1]))
+            lines.append('%s_count{%s="%s"} %d' % (name, label, key, count))
+
+    def render(self):
+        lines = []
+        self.lock.acquire()
+        try:
+            name = self.prefix + '_call_seconds'
+            lines.append('# HELP %s Time spent answering Ice callbacks' % name)
+            lines.append('# TYPE %s histogram' % name)
+            self.render_histograms(lines, name, 'method', self.calls)
+
+            name = self.prefix + '_calls_total'
+            lines.append('# HELP %s Ice callbacks by outcome' % name)
+            lines.append('# TYPE %s counter' % name)
+            for method, outcome in sorted(self.outcomes):
+                lines.append('%s{method="%s",outcome="%s"} %d' % (name, method, outcome, self.outcomes[(method, outcome)]))
+
+            name = self.prefix + '_stage_seconds'
+            lines.append('# HELP %s Time spent in backend stages' % name)
+            lines.append('# TYPE %s histogram' % name)
+            self.render_histograms(lines, name, 'stage', self.stages)
+
+            name = self.prefix + '_murmur_connected'
+            lines.append('# HELP %s Whether the callbacks are attached to the Murmur server' % name)
+            lines.append('# TYPE %s gauge' % name)
+            for endpoint in sorted(self.endpoints):
+                lines.append('%s{endpoint="%s"} %d' % (name, endpoint, self.endpoints[endpoint][0]))
+
+            name = self.prefix + '_murmur_reconnects_total'
+            lines.append('# HELP %s Reattachments after the connection to the Murmur server was lost' % name)
+            lines.append('# TYPE %s counter' % name)
+            for endpoint in sorted(self.endpoints):
+                lines.append('%s{endpoint="%s"} %d' % (name, endpoint, self.endpoints[endpoint][1]))
+        finally:
+            self.lock.release()
+        return '\n'.join(lines) + '\n'
+
+# The prefix is set to the name of the authenticator by setup()
+call_stats = callStatistics('mumbleauth')
+
+def call_outcome(method, result, fallback):
+    """
+    Classifies the result of an Ice callback for the statistics
+    """
+    if method == 'authenticate':
+        if result[0] >= 0:
+            return 'authenticated'
+        elif result[0] == -1:
+            return 'refused'
+        return 'fall_through'
+    elif fallback is not None and result == fallback:
+        return 'fall_through'
+    return 'answered'
+
+class statsHandler(BaseHTTPRequestHandler):
+    """
+    Serves the statistics in the Prometheus text format
+    """
+
+    def do_GET(self):
+        if self.path not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        body = call_stats.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        debug('Statistics request from %s: ' + format, self.client_address[0], *args)
+
+class statsExporter(object):
+    """
+    Publishes the callback statistics on a local HTTP endpoint and/or
+    writes them to a file every interval seconds
+    """
+
+    def __init__(self, host, port, filename, interval):
+        self.filename = filename
+        self.interval = interval
+        self.server = None
+
+        if port:
+            try:
+                self.server = HTTPServer((host, port), statsHandler)
+            except (IOError, OSError) as e:
+                error('Could not serve statistics on %s:%d: %s', host, port, str(e))
+            else:
+                server = Thread(target = self.server.serve_forever, name = 'StatsServer')
+                server.daemon = True
+                server.start()
+                info('Serving statistics on http://%s:%d/metrics', host, port)
+
+        if filename:
+            writer = Thread(target = self.work, name = 'StatsWriter')
+            writer.daemon = True
+            writer.start()
+
+    def write(self):
+        # Replace the file at once so readers never see half of it
+        temp = self.filename + '.tmp'
+        f = open(temp, 'w')
+        try:
+            f.write(call_stats.render())
+        finally:
+            f.close()
+        os.rename(temp, self.filename)
+
+    def work(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.write()
+            except (IOError, OSError) as e:
+                warning('Could not write statistics to %s: %s', self.filename, str(e))
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+        if self.filename:
+            try:
+                self.write()
+            except (IOError, OSError) as e:
+                warning('Could not write statistics to %s: %s', self.filename, str(e))
+
+class threadDbException(Exception): pass
+class bufferedCursor(object):
+    """
+    Minimal cursor replacement holding an already fetched result set so
+    the connection it came from can go back into the pool right away
+    """
+
+    def __init__(self, rows, rowcount):
+        self.rows = list(rows or [])
+        self.rowcount = rowcount
+
+    def fetchone(self):
+        if not self.rows:
+            return None
+        return self.rows.pop(0)
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+    def close(self):
+        self.rows = []
+
+class connectionPool(object):
+    """
+    Bounded pool of connections shared by multiple threads. Subclasses keep
+    their own lock, idle_connections, connection_count and stats and provide
+    the connect, alive and close hooks for their kind of connection.
+    """
+
+    section = None # Config section with the pool_* settings
+    kind = None # Connection name used in log messages
+    exception = Exception # Raised when no connection can be had
+
+    def settings(cls):
+        return getattr(cfg, cls.section)
+    settings = classmethod(settings)
+
+    def connect(cls):
+        """
+        Opens a new connection, raises cls.exception on failure
+        """
+        raise NotImplementedError()
+    connect = classmethod(connect)
+
+    def alive(cls, con):
+        """
+        Returns False if a connection that sat in the pool for pool_check
+        seconds does not work anymore
+        """
+        return True
+    alive = classmethod(alive)
+
+    def close(cls, con):
+        con.close()
+    close = classmethod(close)
+
+    def count(cls, key):
+        cls.lock.acquire()
+        try:
+            cls.stats[key] += 1
+        finally:
+            cls.lock.release()
+    count = classmethod(count)
+
+    def evict_idle(cls):
+        """
+        Closes connections that were idle for longer than pool_idle seconds
+        while keeping at least pool_min connections around. Caller must
+        hold the lock.
+        """
+        settings = cls.settings()
+        if settings.pool_idle <= 0:
+            return
+
+        deadline = time.time() - settings.pool_idle
+        # The list is ordered by last use so stale connections are in front
+        while cls.idle_connections and cls.connection_count > settings.pool_min:
+            con, last_use = cls.idle_connections[0]
+            if last_use > deadline:
+                break
+            del cls.idle_connections[0]
+            cls.connection_count -= 1
+            debug('Closing %s connection idle for %ds', cls.kind, time.time() - last_use)
+            cls.close(con)
+    evict_idle = classmethod(evict_idle)
+
+    def checkout(cls):
+        """
+        Takes a connection out of the pool, opening a new one if the pool
+        is not yet exhausted and waiting for a free one otherwise.
+        """
+        settings = cls.settings()
+        start = time.time()
+        waited = False
+
+        cls.lock.acquire()
+        try:
+            cls.evict_idle()
+            while not cls.idle_connections and cls.connection_count >= settings.pool_max:
+                remaining = start + settings.pool_timeout - time.time()
+                if remaining <= 0:
+                    cls.stats['timeouts'] += 1
+                    error('Timed out after %ds waiting for a free %s connection', settings.pool_timeout, cls.kind)
+                    raise cls.exception()
+                waited = True
+                cls.lock.wait(remaining)
+
+            if cls.idle_connections:
+                con, last_use = cls.idle_connections.pop()
+            else:
+                # Reserve the slot now, the actual connect happens unlocked
+                con, last_use = None, None
+                cls.connection_count += 1
+
+            wait = time.time() - start
+            cls.stats['checkouts'] += 1
+            if waited:
+                cls.stats['waits'] += 1
+                cls.stats['wait_time'] += wait
+                cls.stats['max_wait'] = max(cls.stats['max_wait'], wait)
+        finally:
+            cls.lock.release()
+
+        if waited:
+            debug('Waited %.3fs for a free %s connection', wait, cls.kind)
+
+        if con is not None and time.time() - last_use >= settings.pool_check:
+            # Connection sat in the pool for a while, make sure it is still alive
+            if not cls.alive(con):
+                cls.close(con)
+                con = None
+
+        if con is None:
+            try:
+                con = cls.connect()
+            except cls.exception:
+                cls.discard()
+                raise
+        return con
+    checkout = classmethod(checkout)
+
+    def fill(cls):
+        """
+        Opens connections until the pool holds at least pool_min of them
+        """
+        settings = cls.settings()
+        while True:
+            cls.lock.acquire()
+            try:
+                if cls.connection_count >= settings.pool_min:
+                    return
+                cls.connection_count += 1
+            finally:
+                cls.lock.release()
+
+            try:
+                con = cls.connect()
+            except cls.exception:
+                cls.discard()
+                return
+            cls.checkin(con)
+    fill = classmethod(fill)
+
+    def checkin(cls, con):
+        """
+        Returns a healthy connection to the pool
+        """
+        cls.lock.acquire()
+        try:
+            cls.idle_connections.append((con, time.time()))
+            cls.lock.notify()
+        finally:
+            cls.lock.release()
+    checkin = classmethod(checkin)
+
+    def discard(cls, con = None):
+        """
+        Frees the pool slot of a broken connection
+        """
+        if con is not None:
+            debug('Invalidate %s connection', cls.kind)
+            cls.close(con)
+
+        cls.lock.acquire()
+        try:
+            cls.connection_count -= 1
+            cls.lock.notify()
+        finally:
+            cls.lock.release()
+    discard = classmethod(discard)
+
+    def statistics(cls):
+        """
+        Returns a snapshot of the pool state and wait time counters
+        """
+        cls.lock.acquire()
+        try:
+            stats = dict(cls.stats)
+            stats['open'] = cls.connection_count
+            stats['idle'] = len(cls.idle_connections)
+        finally:
+            cls.lock.release()
+        return stats
+    statistics = classmethod(statistics)
+
+    def disconnect(cls):
+        cls.lock.acquire()
+        try:
+            while cls.idle_connections:
+                con, last_use = cls.idle_connections.pop()
+                cls.connection_count -= 1
+                debug('Close %s connection', cls.kind)
+                cls.close(con)
+        finally:
+            cls.lock.release()
+
+        stats = cls.statistics()
+        info('%s pool: %d checkouts, %d waited %.3fs total (max %.3fs), %d timeouts',
+             cls.kind[:1].upper() + cls.kind[1:], stats['checkouts'], stats['waits'], stats['wait_time'],
+             stats['max_wait'], stats['timeouts'])
+    disconnect = classmethod(disconnect)
+
+class threadDB(connectionPool):
+    """
+    Small abstraction to handle a bounded pool of database connections
+    shared by multiple threads
+    """
+
+    section = 'database'
+    kind = 'database'
+    exception = threadDbException
+    group_concat_max_len = 65535 # Set on every connection with join_groups
+
+    lock = Condition()
+    idle_connections = [] # (connection, last use) tuples, most recently used last
+    connection_count = 0
+    stats = {'checkouts': 0,
+             'waits': 0,
+             'wait_time': 0.0,
+             'max_wait': 0.0,
+             'timeouts': 0}
+
+    def connect(cls):
+        info('Connecting to database server (%s %s:%d %s), pool slot %d of %d',
+             cfg.database.lib, cfg.database.host, cfg.database.port, cfg.database.name,
+             cls.connection_count, cfg.database.pool_max)
+
+        try:
+            con = db.connect(host = cfg.database.host,
+                               port = cfg.database.port,
+                               user = cfg.database.user,
+                               passwd = cfg.database.password,
+                               db = cfg.database.name,
+                               charset = 'utf8')
+            # Transactional engines like InnoDB initiate a transaction even
+            # on SELECTs-only. Thus, we auto-commit so we get recent data.
+            con.autocommit(True)
+            if cfg.database.join_groups:
+                # GROUP_CONCAT silently cuts the group names of users in many
+                # groups at 1024 bytes by default
+                try:
+                    c = con.cursor()
+                    c.execute('SET SESSION group_concat_max_len = %d' % cls.group_concat_max_len)
+                    c.close()
+                except db.Error:
+                    # Do not leave the connection open on the server till wait_timeout
+                    cls.close(con)
+                    raise
+        except db.Error as e:
+            error('Could not connect to database: %s', str(e))
+            raise threadDbException()
+        return con
+    connect = classmethod(connect)
+
+    def alive(cls, con):
+        try:
+            con.ping()
+        except db.Error as e:
+            debug('Pooled database connection failed health check: %s', str(e))
+            return False
+        return True
+    alive = classmethod(alive)
+
+    def close(cls, con):
+        try:
+            con.close()
+        except db.Error:
+            pass
+    close = classmethod(close)
+
+    def execute(cls, *args, **kwargs):
+        if "threadDB__retry_execution__" in kwargs:
+            # Have a magic keyword so we can call ourselves while preventing
+            # an infinite loop
+            del kwargs["threadDB__retry_execution__"]
+            retry = False
+        else:
+            retry = True
+
+        con = cls.checkout()
+        try:
+            start = time.time()
+            c = con.cursor()
+            c.execute(*args, **kwargs)
+            if c.description:
+                res = bufferedCursor(c.fetchall(), c.rowcount)
+            else:
+                res = bufferedCursor(None, c.rowcount)
+            c.close()
+            call_stats.stage('database', time.time() - start)
+        except db.OperationalError as e:
+            error('Database operational error %d: %s', e.args[0], e.args[1])
+            cls.discard(con)
+            if retry:
+                # Make sure we only retry once
+                info('Retrying database operation')
+                kwargs["threadDB__retry_execution__"] = True
+                return cls.execute(*args, **kwargs)
+            else:
+                error('Database operation failed ultimately')
+                raise threadDbException()
+        except:
+            # A half read result would break the next query on this connection
+            cls.discard(con)
+            raise
+
+        cls.checkin(con)
+        return res
+    execute = classmethod(execute)
+
+class lruCache(object):
+    """
+    Small thread safe mapping with a bounded number of entries that are
+    evicted least recently used first and expire after a time to live
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.lock = Lock()
+        self.entries = OrderedDict() # key -> (expiry, value), least recently used first
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default = None):
+        self.lock.acquire()
+        try:
+            try:
+                expiry, value = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+
+            if expiry < time.time():
+                self.misses += 1
+                return default
+
+            # Re-insert to mark the entry as most recently used
+            self.entries[key] = (expiry, value)
+            self.hits += 1
+            return value
+        finally:
+            self.lock.release()
+
+    def put(self, key, value, ttl = None):
+        if ttl is None:
+            ttl = self.ttl
+        if self.size <= 0 or ttl <= 0:
+            return
+
+        self.lock.acquire()
+        try:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + ttl, value)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last = False)
+        finally:
+            self.lock.release()
+
+    def invalidate(self, key):
+        self.lock.acquire()
+        try:
+            self.entries.pop(key, None)
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+        finally:
+            self.lock.release()
+
+class negativeCache(object):
+    """
+    Remembers names the user database does not know for ttl seconds, so guests
+    and bots with made up names do not cost a query every time Murmur asks
+    for them. While a name is being looked up, other lookups of the same name
+    wait up to interval seconds for that result instead of querying as well.
+    """
+
+    report = 1000 # Log the hit ratio every this many lookups
+
+    def __init__(self, size, ttl, interval):
+        self.size = size
+        self.ttl = ttl
+        self.interval = interval
+        self.lock = Condition()
+        self.entries = OrderedDict() # name -> (expiry, known missing), oldest first
+        self.hits = 0
+        self.limited = 0
+        self.misses = 0
+
+    def store(self, name, expiry, missing):
+        """
+        Caller must hold the lock
+        """
+        self.entries.pop(name, None)
+        self.entries[name] = (expiry, missing)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last = False)
+
+    def skip(self, name):
+        """
+        Returns True if the name is known to be missing. Otherwise returns
+        False and the caller has to look the name up, reporting the result
+        with missing, found or release. If another thread is already looking
+        the name up, waits for its result first.
+        """
+        if self.size <= 0:
+            return False
+
+        now = time.time()
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(name)
+            if entry and not entry[1] and entry[0] > now:
+                # Lookup in flight, wait until it settles or its reservation runs out
+                while self.entries.get(name) is entry and entry[0] > now:
+                    self.lock.wait(entry[0] - now)
+                    now = time.time()
+                waited = True
+                entry = self.entries.get(name)
+            else:
+                waited = False
+
+            if entry and entry[1] and entry[0] > now:
+                if waited:
+                    self.limited += 1
+                else:
+                    self.hits += 1
+                skip = True
+            else:
+                if not waited and self.interval > 0:
+                    self.store(name, now + self.interval, False)
+                elif entry and entry[0] <= now:
+                    self.entries.pop(name, None)
+                self.misses += 1
+                skip = False
+            lookups = self.hits + self.limited + self.misses
+        finally:
+            self.lock.release()
+
+        if lookups % self.report == 0:
+            self.log_statistics(debug)
+        return skip
+
+    def missing(self, name):
+        if self.size <= 0:
+            return
+        if self.ttl <= 0:
+            self.release(name)
+            return
+
+        self.lock.acquire()
+        try:
+            self.store(name, time.time() + self.ttl, True)
+            self.lock.notify_all()
+        finally:
+            self.lock.release()
+
+    def found(self, name):
+        self.lock.acquire()
+        try:
+            self.entries.pop(name, None)
+            self.lock.notify_all()
+        finally:
+            self.lock.release()
+
+    def release(self, name):
+        """
+        Drops the reservation of a lookup that failed, so waiting and later
+        lookups query again
+        """
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(name)
+            if entry and not entry[1]:
+                del self.entries[name]
+                self.lock.notify_all()
+        finally:
+            self.lock.release()
+
+    def log_statistics(self, log = debug):
+        self.lock.acquire()
+        try:
+            lookups = self.hits + self.limited + self.misses
+            log('Unknown name cache: %d lookups, %d hits, %d after waiting for a running lookup, %.1f%% saved, %d names',
+                lookups, self.hits, self.limited,
+                100.0 * (self.hits + self.limited) / max(lookups, 1), len(self.entries))
+        finally:
+            self.lock.release()
+
+class nameCache(object):
+    """
+    Bounded map between user names and user ids that can be queried
+    in both directions. Entries expire ttl seconds after they were stored.
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.lock = Lock()
+        self.names = OrderedDict() # name -> (uid, expiry), least recently used first
+        self.uids = {} # uid -> name
+        self.hits = 0
+        self.misses = 0
+
+    def drop(self, name):
+        """
+        Removes a name and its id, caller must hold the lock
+        """
+        uid, expiry = self.names.pop(name)
+        del self.uids[uid]
+
+    def put(self, name, uid):
+        if self.size <= 0:
+            return
+
+        self.lock.acquire()
+        try:
+            # A name or id changing hands replaces the old pairing
+            if name in self.names:
+                self.drop(name)
+            if uid in self.uids:
+                self.drop(self.uids[uid])
+
+            self.names[name] = (uid, time.time() + self.ttl)
+            self.uids[uid] = name
+            while len(self.names) > self.size:
+                oldest = next(iter(self.names))
+                self.drop(oldest)
+        finally:
+            self.lock.release()
+
+    def get(self, name):
+        """
+        Returns the cached (name, uid) pair for the given name or None
+        """
+        self.lock.acquire()
+        try:
+            entry = self.names.get(name)
+            if entry is None or entry[1] < time.time():
+                if entry is not None:
+                    self.drop(name)
+                self.misses += 1
+                return None
+
+            # Re-insert to mark the entry as most recently used
+            del self.names[name]
+            self.names[name] = entry
+            self.hits += 1
+            return (name, entry[0])
+        finally:
+            self.lock.release()
+
+    def name(self, uid):
+        """
+        Returns the cached name of the given id or None
+        """
+        self.lock.acquire()
+        try:
+            name = self.uids.get(uid)
+        finally:
+            self.lock.release()
+
+        if name is None:
+            self.lock.acquire()
+            try:
+                self.misses += 1
+            finally:
+                self.lock.release()
+            return None
+
+        entry = self.get(name)
+        return entry and entry[0]
+
+    def uid(self, name):
+        """
+        Returns the cached id of the given name or None
+        """
+        entry = self.get(name)
+        return entry and entry[1]
+
+class textureCache(object):
+    """
+    Byte bounded LRU cache for avatar images. Downloaded entries expire
+    after a time to live and are then revalidated with the server (ETag
+    and Last-Modified) before they get downloaded again. Entries read from
+    local files stay valid as long as the file is not modified.
+    """
+
+    def __init__(self, max_bytes, ttl, headers = None, transform = None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.headers = headers or {}
+        self.transform = transform # Applied once to every image before it is cached
+        self.lock = Lock()
+        # location -> [expiry, data, validator, last modified], least recently used first.
+        # Local files have no expiry and use their stat result as validator.
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.evictions = 0
+
+    def lookup(self, location):
+        self.lock.acquire()
+        try:
+            entry = self.entries.pop(location, None)
+            if entry is not None:
+                self.entries[location] = entry
+            return entry
+        finally:
+            self.lock.release()
+
+    def count(self, hit):
+        self.lock.acquire()
+        try:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        finally:
+            self.lock.release()
+
+    def store(self, location, data, expiry, validator, modified):
+        size = len(data)
+        if size > self.max_bytes:
+            debug('Texture "%s" with %d bytes exceeds the cache size, not caching it', location, size)
+            return
+
+        self.lock.acquire()
+        try:
+            old = self.entries.pop(location, None)
+            if old is not None:
+                self.bytes -= len(old[1])
+            while self.entries and self.bytes + size > self.max_bytes:
+                evicted_location, evicted = self.entries.popitem(last = False)
+                self.bytes -= len(evicted[1])
+                self.evictions += 1
+            self.entries[location] = [expiry, data, validator, modified]
+            self.bytes += size
+        finally:
+            self.lock.release()
+
+    def fresh(self, location, entry):
+        if entry[0] is None:
+            # Local file, current as long as it did not change on disk
+            try:
+                return entry[2] == file_validator(os.stat(location))
+            except OSError:
+                return False
+        return entry[0] >= time.time()
+
+    def peek(self, location):
+        """
+        Returns the cached image for location, or None, and whether it is
+        still fresh without ever touching the network
+        """
+        entry = self.lookup(location)
+        if entry is None:
+            self.count(False)
+            return None, False
+
+        fresh = self.fresh(location, entry)
+        self.count(fresh)
+        return entry[1], fresh
+
+    def retrieve(self, location):
+        """
+        Returns the image stored at location, which is either an url or an
+        absolute path to a local file, from the cache if possible. Raises
+        URLError, IOError or OSError if it could not be retrieved.
+        """
+        if os.path.isabs(location):
+            return self.load(location)
+        return self.fetch(location)
+
+    def load(self, path):
+        """
+        Reads the image from a local file, skipping the read if the file
+        did not change since it was cached
+        """
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            stat = os.fstat(fd)
+            validator = file_validator(stat)
+
+            entry = self.lookup(path)
+            if entry is not None and entry[0] is None and entry[2] == validator:
+                self.count(True)
+                return entry[1]
+            self.count(False)
+
+            # Size the read from the stat result, one syscall for usual avatars
+            chunks = []
+            remaining = stat.st_size
+            while remaining > 0:
+                chunk = os.read(fd, remaining)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                remaining -= len(chunk)
+            data = b''.join(chunks)
+        finally:
+            os.close(fd)
+
+        if self.transform:
+            data = self.transform(data)
+
+        if self.max_bytes > 0:
+            self.store(path, data, None, validator, None)
+        self.log_statistics()
+        return data
+
+    def fetch(self, url):
+        """
+        Downloads the image at url unless the cached copy is still fresh
+        """
+        entry = self.lookup(url)
+        if entry is not None and entry[0] is not None and entry[0] >= time.time():
+            self.count(True)
+            return entry[1]
+        self.count(False)
+
+        request = Request(url, headers = self.headers)
+        if entry is not None and entry[0] is not None:
+            # Expired, ask the server whether our copy is still current
+            if entry[2]:
+                request.add_header('If-None-Match', entry[2])
+            if entry[3]:
+                request.add_header('If-Modified-Since', entry[3])
+
+        start = time.time()
+        try:
+            handle = urlopen(request)
+            try:
+                data = handle.read()
+                etag = handle.info().get('ETag')
+                modified = handle.info().get('Last-Modified')
+            finally:
+                handle.close()
+        except HTTPError as e:
+            if e.code != 304 or entry is None:
+                raise
+            self.lock.acquire()
+            try:
+                entry[0] = time.time() + self.ttl
+                self.revalidated += 1
+            finally:
+                self.lock.release()
+            debug('Texture "%s" not modified', url)
+            self.log_statistics()
+            return entry[1]
+        finally:
+            call_stats.stage('http', time.time() - start)
+
+        if self.transform:
+            data = self.transform(data)
+
+        if self.max_bytes > 0:
+            self.store(url, data, time.time() + self.ttl, etag, modified)
+        self.log_statistics()
+        return data
+
+    def log_statistics(self, log = debug):
+        log('Texture cache: %d hits, %d misses, %d revalidated, %d evicted, %d entries using %d of %d bytes',
+            self.hits, self.misses, self.revalidated, self.evictions, len(self.entries), self.bytes, self.max_bytes)
+
+def file_validator(stat):
+    """
+    Identifies a version of a local file by its stat result
+    """
+    return (stat.st_ino, stat.st_size, stat.st_mtime)
+
+def shrink_texture(data):
+    """
+    Scales an avatar down to fit into avatar_max_size pixels and recompresses
+    it. Returns the original data if it can not be decoded or would not get
+    any smaller.
+    """
+    try:
+        image = Image.open(io.BytesIO(data))
+        image.load()
+    except Exception as e:
+        debug('Could not decode texture, passing it on unmodified: %s', str(e))
+        return data
+
+    resized = max(image.size) > cfg.user.avatar_max_size
+    if resized:
+        image.thumbnail((cfg.user.avatar_max_size, cfg.user.avatar_max_size), getattr(Image, 'LANCZOS', None) or Image.ANTIALIAS)
+
+    if cfg.user.avatar_format.upper() == 'JPEG':
+        image = image.convert('RGB')
+    elif image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA')
+
+    out = io.BytesIO()
+    image.save(out, cfg.user.avatar_format, optimize = True)
+    shrunk = out.getvalue()
+    if not resized and len(shrunk) >= len(data):
+        return data
+
+    debug('Texture shrunk from %d to %d bytes', len(data), len(shrunk))
+    return shrunk
+
+class texturePrefetcher(object):
+    """
+    Small pool of background threads warming the texture cache so Ice
+    threads never have to wait for an avatar download
+    """
+
+    def __init__(self, resolve, cache, workers, queue_size):
+        self.resolve = resolve # Maps a forum user id to its avatar url or None
+        self.cache = cache
+        self.queue = queue.Queue(queue_size)
+        self.lock = Lock()
+        self.pending = set()
+        self.urls = lruCache(queue_size * 100, cache.ttl)
+
+        for i in range(workers):
+            worker = Thread(target = self.work, name = 'TexturePrefetch-%d' % i)
+            worker.daemon = True
+            worker.start()
+
+    def enqueue(self, uid):
+        """
+        Schedules the avatar of the given forum user for download unless
+        that is already pending. Never blocks.
+        """
+        self.lock.acquire()
+        try:
+            if uid in self.pending:
+                return
+            self.pending.add(uid)
+        finally:
+            self.lock.release()
+
+        try:
+            self.queue.put_nowait(uid)
+        except queue.Full:
+            debug('Texture prefetch queue full, skipping user %d', uid)
+            self.done(uid)
+
+    def done(self, uid):
+        self.lock.acquire()
+        try:
+            self.pending.discard(uid)
+        finally:
+            self.lock.release()
+
+    def lookup(self, uid):
+        """
+        Returns the prefetched avatar of the given forum user or None if it
+        is not available yet. Stale images are returned while a refresh is
+        scheduled in the background.
+        """
+        url = self.urls.get(uid)
+        if url is None:
+            self.enqueue(uid)
+            return None
+
+        texture, fresh = self.cache.peek(url)
+        if not fresh:
+            self.enqueue(uid)
+        return texture
+
+    def work(self):
+        while True:
+            uid = self.queue.get()
+            try:
+                url = self.resolve(uid)
+                if url:
+                    self.cache.retrieve(url)
+                    self.urls.put(uid, url)
+                else:
+                    self.urls.invalidate(uid)
+            except threadDbException:
+                pass
+            except (URLError, IOError, OSError) as e:
+                warning('Prefetching texture for user %d failed: %s', uid, str(e))
+            except Exception as e:
+                critical('Unexpected exception caught while prefetching texture')
+                exception(e)
+            self.done(uid)
+
+class groupDirectory(object):
+    """
+    In-memory map of forum group ids to group names, reloaded from the
+    database in the background every refresh seconds
+    """
+
+    def __init__(self, statement, refresh):
+        self.statement = statement # Returns (group id, group name) rows
+        self.refresh = refresh
+        self.lock = Lock()
+        self.names = None
+        self.unknown = set() # Ids still missing after a forced reload
+        self.reloads = 0
+
+        worker = Thread(target = self.work, name = 'GroupDirectory')
+        worker.daemon = True
+        worker.start()
+
+    def reload(self):
+        """
+        Replaces the map with the current contents of the group table.
+        Raises threadDbException if the database is unavailable.
+        """
+        cur = threadDB.execute(self.statement)
+        names = dict((gid, name) for gid, name in cur.fetchall())
+        cur.close()
+
+        self.lock.acquire()
+        try:
+            self.names = names
+            self.reloads += 1
+        finally:
+            self.lock.release()
+        debug('Loaded %d group names', len(names))
+
+    def missing(self, gids):
+        self.lock.acquire()
+        try:
+            if self.names is None:
+                return True
+            for gid in gids:
+                if gid not in self.names and gid not in self.unknown:
+                    return True
+            return False
+        finally:
+            self.lock.release()
+
+    def resolve(self, gids):
+        """
+        Returns the names of the given group ids, skipping ids without a
+        group. Ids not seen before force one reload so groups created
+        since the last refresh are picked up right away.
+        """
+        if self.missing(gids):
+            debug('Group directory miss, forcing reload')
+            self.reload()
+
+        self.lock.acquire()
+        try:
+            groups = []
+            for gid in gids:
+                name = self.names.get(gid)
+                if name is None:
+                    self.unknown.add(gid)
+                elif name not in groups:
+                    groups.append(name)
+            return groups
+        finally:
+            self.lock.release()
+
+    def work(self):
+        while True:
+            try:
+                self.reload()
+            except threadDbException:
+                warning('Could not refresh the group directory, keeping the old one')
+            except Exception as e:
+                error('Unexpected error while refreshing the group directory: %s', str(e))
+            time.sleep(self.refresh)
+
+def name_key(name):
+    """
+    Case folds a user name for lookups like the database collation does.
+    Under Python 2 Ice hands us utf-8 encoded strings, the database unicode.
+    """
+    if isinstance(name, bytes) and bytes is str:
+        name = name.decode('utf-8', 'replace')
+    return name.lower()
+
+def like_regex(pattern):
+    """
+    Translates an SQL LIKE pattern into a regular expression matching the
+    whole string
+    """
+    regex = []
+    escaped = False
+    for c in pattern:
+        if escaped:
+            regex.append(re.escape(c))
+            escaped = False
+        elif c == '\\':
+            escaped = True
+        elif c == '%':
+            regex.append('.*')
+        elif c == '_':
+            regex.append('.')
+        else:
+            regex.append(re.escape(c))
+    return re.compile(''.join(regex) + r'\Z', re.S)
+
+def trigrams(text):
+    return set(text[i:i + 3] for i in range(len(text) - 2))
+
+class trigramIndex(object):
+    """
+    Maps every sequence of three characters in a set of names to the ids of
+    the names containing it, so a substring search only has to look at the
+    names that share all trigrams with the searched string. The owner
+    serializes access.
+    """
+
+    def __init__(self):
+        self.postings = {} # trigram -> set of ids
+
+    def add(self, id, text):
+        for gram in trigrams(text):
+            self.postings.setdefault(gram, set()).add(id)
+
+    def remove(self, id, text):
+        for gram in trigrams(text):
+            ids = self.postings.get(gram)
+            if ids is not None:
+                ids.discard(id)
+                if not ids:
+                    del self.postings[gram]
+
+    def candidates(self, parts):
+        """
+        Returns the ids of the names containing every trigram of the given
+        substrings, None if none of them is long enough to have one
+        """
+        grams = set()
+        for part in parts:
+            grams.update(trigrams(part))
+        if not grams:
+            return None
+
+        # Intersect starting with the rarest trigram
+        postings = sorted([self.postings.get(gram, set()) for gram in grams], key = len)
+        result = set(postings[0])
+        for ids in postings[1:]:
+            if not result:
+                break
+            result &= ids
+        return result
+
+class userDirectory(object):
+    """
+    In-memory copy of the ids, names and states of all forum users so
+    nameToId, idToName and getRegisteredUsers do not query the database.
+    Users registered since the last load are fetched by id every refresh
+    seconds, the whole table every full_refresh seconds to pick up renames,
+    activations and deletions.
+    """
+
+    def __init__(self, statement, listed, refresh, full_refresh):
+        self.statement = statement # Returns (id, name, state) rows with an id above the argument, by id
+        self.listed = listed # Tells by the state if getRegisteredUsers includes a user
+        self.refresh = refresh
+        self.full_refresh = full_refresh
+        self.lock = Lock()
+        self.ids = array('l') # Ascending, the other arrays are in the same order
+        self.names = []
+        self.states = array('l')
+        self.keys = [] # Case folded names
+        self.index = {} # name key -> position
+        self.sorted = [] # (name key, position) tuples sorted for prefix searches
+        self.trigrams = trigramIndex() # Positions by the trigrams of their key, for substring searches
+        self.loaded = False
+
+        worker = Thread(target = self.work, name = 'UserDirectory')
+        worker.daemon = True
+        worker.start()
+
+    def reload(self, full):
+        """
+        Loads the whole user table or just the users added since the last
+        load. Raises threadDbException if the database is unavailable.
+        """
+        self.lock.acquire()
+        try:
+            since = -1
+            if not full and self.ids:
+                since = self.ids[-1]
+        finally:
+            self.lock.release()
+
+        cur = threadDB.execute(self.statement, [since])
+        rows = cur.fetchall()
+        cur.close()
+
+        if full:
+            ids = array('l', [row[0] for row in rows])
+            names = [row[1] for row in rows]
+            states = array('l', [row[2] for row in rows])
+            keys = [name_key(name) for name in names]
+            index = dict((keys[pos], pos) for pos in range(len(keys)))
+            ordered = sorted((keys[pos], pos) for pos in range(len(keys)))
+            grams = trigramIndex()
+            for pos in range(len(keys)):
+                grams.add(pos, keys[pos])
+
+            self.lock.acquire()
+            try:
+                self.ids, self.names, self.states, self.keys = ids, names, states, keys
+                self.index, self.sorted, self.trigrams = index, ordered, grams
+                self.loaded = True
+            finally:
+                self.lock.release()
+            debug('Loaded %d users', len(names))
+        elif rows:
+            self.lock.acquire()
+            try:
+                for uid, name, state in rows:
+                    if self.ids and uid <= self.ids[-1]:
+                        continue # Already added by a full load in the meantime
+                    key = name_key(name)
+                    pos = len(self.names)
+                    self.ids.append(uid)
+                    self.names.append(name)
+                    self.states.append(state)
+                    self.keys.append(key)
+                    self.index[key] = pos
+                    bisect.insort(self.sorted, (key, pos))
+                    self.trigrams.add(pos, key)
+            finally:
+                self.lock.release()
+            debug('Added %d new users', len(rows))
+
+    def uid(self, name):
+        self.lock.acquire()
+        try:
+            pos = self.index.get(name_key(name))
+            if pos is None:
+                return None
+            return self.ids[pos]
+        finally:
+            self.lock.release()
+
+    def name(self, uid):
+        self.lock.acquire()
+        try:
+            pos = bisect.bisect_left(self.ids, uid)
+            if pos < len(self.ids) and self.ids[pos] == uid:
+                return self.names[pos]
+            return None
+        finally:
+            self.lock.release()
+
+    def filter(self, pattern, limit = 0):
+        """
+        Returns (id, name) tuples of the listed users whose name matches the
+        LIKE pattern, ignoring case like the database collation does. At
+        most limit users are returned if it is positive.
+        """
+        key = name_key(pattern)
+        wildcards = '%' in key or '_' in key or '\\' in key
+
+        self.lock.acquire()
+        try:
+            if not wildcards or (key.endswith('%') and not ('%' in key[:-1] or '_' in key or '\\' in key)):
+                # Exact names and prefixes are a range of the sorted list
+                exact = not wildcards
+                prefix = exact and key or key[:-1]
+                positions = []
+                i = bisect.bisect_left(self.sorted, (prefix,))
+                while i < len(self.sorted):
+                    other, pos = self.sorted[i]
+                    if (exact and other != prefix) or not other.startswith(prefix):
+                        break
+                    positions.append(pos)
+                    i += 1
+            else:
+                match = like_regex(key).match
+                candidates = None
+                if '\\' not in key:
+                    # Only names containing the literal parts can match
+                    candidates = self.trigrams.candidates(re.split('[%_]', key))
+                if candidates is None:
+                    positions = [pos for other, pos in self.sorted if match(other)]
+                else:
+                    positions = [pos for pos in candidates if match(self.keys[pos])]
+                    positions.sort(key = lambda pos: self.keys[pos])
+
+            users = []
+            for pos in positions:
+                if self.listed(self.states[pos]):
+                    users.append((self.ids[pos], self.names[pos]))
+                    if len(users) == limit:
+                        break
+            return users
+        finally:
+            self.lock.release()
+
+    def work(self):
+        next_full = 0
+        while True:
+            full = time.time() >= next_full
+            try:
+                self.reload(full)
+                if full:
+                    next_full = time.time() + self.full_refresh
+            except threadDbException:
+                warning('Could not refresh the user directory, keeping the old one')
+            except Exception as e:
+                error('Unexpected error while refreshing the user directory: %s', str(e))
+            time.sleep(self.refresh)
+
+class hashRegistry(object):
+    """
+    Maps password hash formats, recognized by their prefix, to the
+    functions verifying them and keeps per scheme cost statistics
+    """
+
+    def __init__(self):
+        self.schemes = [] # (prefix, name, check, cost, expensive), longest prefix first
+        self.lock = Lock()
+        self.stats = {}
+
+    def register(self, name, prefix, check, cost = None, expensive = False):
+        """
+        Adds a scheme. check(password, hash, *extra) returns whether the
+        password matches, cost(hash) the work factor stored in the hash.
+        An empty prefix matches every hash no other scheme claims.
+        Expensive schemes are verified in the worker pool if enabled.
+        """
+        self.schemes.append((prefix, name, check, cost, expensive))
+        self.schemes.sort(key = lambda scheme: len(scheme[0]), reverse = True)
+
+    def lookup(self, hash):
+        for prefix, name, check, cost, expensive in self.schemes:
+            if hash.startswith(prefix):
+                return (name, check, cost, expensive)
+        return None
+
+    def check(self, password, hash, *extra):
+        """
+        Verifies password against hash in the calling thread
+        """
+        scheme = self.lookup(hash)
+        if scheme is None:
+            warning('Unsupported password hash format "%s..."', hash[:7])
+            return False
+        name, check, cost, expensive = scheme
+
+        start = time.time()
+        result = check(password, hash, *extra)
+        self.record(name, hash, time.time() - start)
+        return result
+
+    def record(self, name, hash, elapsed):
+        scheme = self.lookup(hash)
+        cost = scheme and scheme[2] and scheme[2](hash)
+
+        self.lock.acquire()
+        try:
+            stats = self.stats.setdefault(name, {'checks': 0, 'time': 0.0, 'max_time': 0.0, 'costs': {}})
+            stats['checks'] += 1
+            stats['time'] += elapsed
+            stats['max_time'] = max(stats['max_time'], elapsed)
+            stats['costs'][cost] = stats['costs'].get(cost, 0) + 1
+        finally:
+            self.lock.release()
+
+    def log_statistics(self, log = debug):
+        self.lock.acquire()
+        try:
+            for name in sorted(self.stats):
+                stats = self.stats[name]
+                log('Hash scheme %s: %d checks, %.3fs average, %.3fs max, cost factors %s', name,
+                    stats['checks'], stats['time'] / stats['checks'], stats['max_time'], stats['costs'])
+        finally:
+            self.lock.release()
+
+class hashVerifierError(Exception):
+    """
+    Raised when a password hash could not be verified in time
+    """
+    pass
+
+def ignore_interrupt():
+    # Leave SIGINT handling to the parent so ctrl+c does not kill the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def verify_in_worker(check, args):
+    """
+    Runs a hash check inside a pool process. Exceptions are returned
+    instead of raised so the completion callback always fires.
+    """
+    try:
+        return (True, check(*args))
+    except Exception as e:
+        return (False, repr(e))
+
+class hashVerifier(object):
+    """
+    Runs the CPU bound password hash checks in a pool of worker processes
+    so concurrent logins are not serialized on the interpreter lock
+    """
+
+    def __init__(self, registry, processes, queue_size, timeout):
+        self.registry = registry
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.lock = Lock()
+        self.pending = 0
+        self.stats = {'verified': 0, 'rejected': 0, 'timeouts': 0}
+        self.pool = None
+        if processes > 0:
+            # Forked before Ice starts its threads, the workers never have
+            # to import the authenticator again
+            context = multiprocessing
+            if hasattr(multiprocessing, 'get_context'):
+                context = multiprocessing.get_context('fork')
+            self.pool = context.Pool(processes, ignore_interrupt)
+
+    def done(self, result):
+        self.lock.acquire()
+        try:
+            self.pending -= 1
+        finally:
+            self.lock.release()
+
+    def verify(self, password, hash, *extra):
+        """
+        Checks password against hash with the scheme registered for the
+        hash format. Expensive schemes run in a worker process if the pool
+        is enabled. Raises hashVerifierError if too many checks are queued
+        or the result does not arrive within the timeout.
+        """
+        start = time.time()
+        try:
+            scheme = self.registry.lookup(hash)
+            if not self.pool or not scheme or not scheme[3]:
+                return self.registry.check(password, hash, *extra)
+            name, check, cost, expensive = scheme
+
+            result = self.submit(check, (password, hash) + extra)
+            self.registry.record(name, hash, time.time() - start)
+            return result
+        finally:
+            call_stats.stage('hashing', time.time() - start)
+
+    def submit(self, check, args):
+        self.lock.acquire()
+        try:
+            if self.pending >= self.queue_size:
+                self.stats['rejected'] += 1
+                warning('Hash verification queue full (%d pending)', self.pending)
+                raise hashVerifierError()
+            self.pending += 1
+            self.stats['verified'] += 1
+        finally:
+            self.lock.release()
+
+        try:
+            job = self.pool.apply_async(verify_in_worker, (check, args), callback = self.done)
+            ok, result = job.get(self.timeout)
+        except multiprocessing.TimeoutError:
+            self.lock.acquire()
+            try:
+                self.stats['timeouts'] += 1
+            finally:
+                self.lock.release()
+            warning('Hash verification timed out after %d seconds', self.timeout)
+            raise hashVerifierError()
+
+        if not ok:
+            warning('Hash verification failed: %s', result)
+            raise hashVerifierError(result)
+        return result
+
+    def close(self):
+        if not self.pool:
+            return
+        self.pool.terminate()
+        self.pool.join()
+        debug('Hash verifier: %(verified)d verified, %(rejected)d rejected, %(timeouts)d timeouts', self.stats)
+
+password_digest_key = os.urandom(16)
+def password_digest(password):
+    """
+    Keyed digest of a password so plaintext passwords never end up
+    as cache keys
+    """
+    if not isinstance(password, bytes):
+        password = password.encode('utf-8')
+    return hmac.new(password_digest_key, password, sha1).digest()
+
+def split_groups(joined):
+    """
+    Splits the newline separated GROUP_CONCAT result of a join_groups
+    query back into a list of group names
+    """
+    if not joined:
+        return []
+    return joined.split('\n')
+
+#
+#--- Forum authenticators
+#
+class forumUser(object):
+    """
+    A forum account as found by forumBackend.lookup_user
+    """
+
+    def __init__(self, uid, name, hash, row, active = True, hash_args = (), groups = None):
+        self.uid = uid # Forum user id, without id_offset
+        self.name = name # Name reported to Murmur
+        self.hash = hash # Stored password hash
+        self.row = row # Cached verdicts are only trusted while this stays the same
+        self.active = active # Inactive users can not log in
+        self.hash_args = hash_args # Extra arguments of the hash check
+        self.groups = groups # Group names if they came along with the user
+
+class forumBackend(object):
+    """
+    Everything forumAuthenticator needs to know about a forum database.
+    Subclasses pass the statements in sql and the hashRegistry of the
+    password hashes the forum uses and implement lookup_user, fetch_groups
+    and fetch_avatar. Caching,
+    pooling, statistics and the Ice side are left to forumAuthenticator.
+
+    sql has to contain the statements name_to_id (user id by name),
+    id_to_name (name by user id), registered_users ((id, name) rows by a
+    LIKE pattern) and user_directory ((id, name, state) rows with an id
+    above the argument, ordered by id).
+    """
+
+    avatar_headers = None # Extra headers sent along with avatar downloads
+
+    def __init__(self, sql, hash_schemes):
+        self.sql = sql
+        self.hash_schemes = hash_schemes
+        # Forks the worker processes, has to happen before Ice starts its threads
+        self.hash_verifier = hashVerifier(self.hash_schemes, cfg.user.hash_processes,
+                                          cfg.user.hash_queue, cfg.user.hash_timeout)
+
+    def lookup_user(self, name):
+        """
+        Returns the forumUser logging in as name or None if there is none.
+        Raises threadDbException if the database is unavailable.
+        """
+        raise NotImplementedError()
+
+    def verify_password(self, user, password):
+        """
+        Checks password against the stored hash of an active user. Raises
+        hashVerifierError if that could not be done in time.
+        """
+        if not user.active:
+            return False
+        return self.hash_verifier.verify(password, user.hash, *user.hash_args)
+
+    def fetch_groups(self, user):
+        """
+        Returns the group names of an authenticated user that did not come
+        along with lookup_user. Raises threadDbException if the database is
+        unavailable.
+        """
+        raise NotImplementedError()
+
+    def fetch_avatar(self, uid):
+        """
+        Returns the url or absolute path of the avatar of the given forum
+        user, None if there is none. Raises threadDbException if the
+        database is unavailable.
+        """
+        return None
+
+    def listed(self, state):
+        """
+        Tells by the state column of user_directory whether a user is
+        included in getRegisteredUsers
+        """
+        return True
+
+    def start(self):
+        pass
+
+    def stop(self):
+        self.hash_verifier.close()
+        self.hash_schemes.log_statistics(info)
+
+def forum_authenticator(backend):
+    """
+    Returns the make_authenticator function serve() needs to serve the
+    users of the given forumBackend
+    """
+
+    def make_authenticator(M, fortifyIceFu, checkSecret):
+        avatarTransform = None
+        if cfg.user.avatar_enable and cfg.user.avatar_resize:
+            if Image:
+                avatarTransform = shrink_texture
+            else:
+                warning('avatar_resize requires the python imaging library (PIL or Pillow), avatars are passed on unmodified')
+
+        if cfg.user.reject_on_error: # Python 2.4 compat
+            authenticateFortifyResult = (-1, None, None)
+        else:
+            authenticateFortifyResult = (-2, None, None)
+
+        class forumAuthenticator(M.ServerUpdatingAuthenticator):
+            def __init__(self):
+                M.ServerUpdatingAuthenticator.__init__(self)
+                self.texture_cache = textureCache(cfg.user.avatar_cache_size * 1024, cfg.user.avatar_cache_ttl,
+                                                  headers = backend.avatar_headers,
+                                                  transform = avatarTransform)
+                self.auth_cache = lruCache(cfg.user.auth_cache_size, cfg.user.auth_cache_ttl)
+                self.unknown_names = negativeCache(cfg.user.unknown_cache_size, cfg.user.unknown_cache_ttl,
+                                                   cfg.user.unknown_query_interval)
+                self.users = None
+                self.prefetcher = None
+
+            def start(self):
+                """
+                Fills the connection pool, then starts the background work
+                """
+                threadDB.fill()
+                backend.start()
+
+                if cfg.user.users_snapshot:
+                    self.users = userDirectory(backend.sql['user_directory'], backend.listed,
+                                               cfg.user.snapshot_refresh, cfg.user.snapshot_full_refresh)
+
+                if cfg.user.avatar_enable and cfg.user.avatar_prefetch:
+                    self.prefetcher = texturePrefetcher(backend.fetch_avatar,
+                                                        self.texture_cache,
+                                                        cfg.user.avatar_prefetch_workers,
+                                                        cfg.user.avatar_prefetch_queue)
+
+            def stop(self):
+                threadDB.disconnect()
+                backend.stop()
+                if cfg.user.avatar_enable:
+                    self.texture_cache.log_statistics(info)
+
+            @fortifyIceFu(authenticateFortifyResult)
+            @checkSecret
+            def authenticate(self, name, pw, certlist, certhash, strong, current = None):
+                """
+                This function is called to authenticate a user
+                """
+
+                # Search for the user in the database
+                FALL_THROUGH = -2
+                AUTH_REFUSED = -1
+
+                if name == 'SuperUser':
+                    debug('Forced fall through for SuperUser')
+                    return (FALL_THROUGH, None, None)
+
+                try:
+                    user = backend.lookup_user(name)
+                except threadDbException:
+                    return (FALL_THROUGH, None, None)
+
+                if not user:
+                    info('Fall through for unknown user "%s"', name)
+                    return (FALL_THROUGH, None, None)
+                # Users registered since nameToId last asked for them exist now
+                self.unknown_names.found(name)
+                uid = user.uid
+
+                cache_key = None
+                if cfg.user.auth_cache_size > 0:
+                    # A cached verdict is only trusted while the user row, and thus
+                    # the stored password hash, stays the same
+                    cache_key = (name, password_digest(pw))
+                    cached = self.auth_cache.get(cache_key)
+                    if cached:
+                        cached_row, result = cached
+                        if cached_row == user.row:
+                            if result[0] == AUTH_REFUSED:
+                                info('Failed authentication attempt for user: "%s" (%d) (cached)', name, uid + cfg.user.id_offset)
+                            else:
+                                info('User authenticated: "%s" (%d) (cached)', name, uid + cfg.user.id_offset)
+                                if self.prefetcher:
+                                    self.prefetcher.enqueue(uid)
+                            return result
+                        self.auth_cache.invalidate(cache_key)
+
+                try:
+                    valid = backend.verify_password(user, pw)
+                except hashVerifierError:
+                    return (FALL_THROUGH, None, None)
+
+                if valid:
+                    groups = user.groups
+                    if groups is None:
+                        # Authenticated, fetch group memberships
+                        try:
+                            groups = backend.fetch_groups(user)
+                        except threadDbException:
+                            return (FALL_THROUGH, None, None)
+
+                    info('User authenticated: "%s" (%d)', name, uid + cfg.user.id_offset)
+                    debug('Group memberships: %s', str(groups))
+                    result = (uid + cfg.user.id_offset, user.name, groups)
+                    if self.prefetcher:
+                        # Warm the texture cache before Murmur asks for the avatar
+                        self.prefetcher.enqueue(uid)
+                    if cache_key:
+                        self.auth_cache.put(cache_key, (user.row, result))
+                    return result
+
+                info('Failed authentication attempt for user: "%s" (%d)', name, uid + cfg.user.id_offset)
+                result = (AUTH_REFUSED, None, None)
+                if cache_key:
+                    self.auth_cache.put(cache_key, (user.row, result), cfg.user.auth_cache_negative_ttl)
+                return result
+
+            @fortifyIceFu((False, None))
+            @checkSecret
+            def getInfo(self, id, current = None):
+                """
+                Gets called to fetch user specific information
+                """
+
+                # We do not expose any additional information so always fall through
+                debug('getInfo for %d -> denied', id)
+                return (False, None)
+
+            @fortifyIceFu(-2)
+            @checkSecret
+            def nameToId(self, name, current = None):
+                """
+                Gets called to get the id for a given username
+                """
+
+                FALL_THROUGH = -2
+                if name == 'SuperUser':
+                    debug('nameToId SuperUser -> forced fall through')
+                    return FALL_THROUGH
+
+                if self.users and self.users.loaded:
+                    uid = self.users.uid(name)
+                    if uid is None:
+                        debug('nameToId %s -> ? (snapshot)', name)
+                        return FALL_THROUGH
+                    debug('nameToId %s -> %d (snapshot)', name, uid + cfg.user.id_offset)
+                    return uid + cfg.user.id_offset
+
+                if self.unknown_names.skip(name):
+                    debug('nameToId %s -> ? (cached)', name)
+                    return FALL_THROUGH
+
+                try:
+                    cur = threadDB.execute(backend.sql['name_to_id'], [name])
+                except threadDbException:
+                    self.unknown_names.release(name)
+                    return FALL_THROUGH
+                except:
+                    # Waiting lookups of the name have to query themselves
+                    self.unknown_names.release(name)
+                    raise
+
+                res = cur.fetchone()
+                cur.close()
+                if not res:
+                    self.unknown_names.missing(name)
+                    debug('nameToId %s -> ?', name)
+                    return FALL_THROUGH
+
+                self.unknown_names.found(name)
+                debug('nameToId %s -> %d', name, (res[0] + cfg.user.id_offset))
+                return res[0] + cfg.user.id_offset
+
+            @fortifyIceFu("")
+            @checkSecret
+            def idToName(self, id, current = None):
+                """
+                Gets called to get the username for a given id
+                """
+
+                FALL_THROUGH = ""
+                # Make sure the ID is in our range and transform it to the actual forum user id
+                if id < cfg.user.id_offset:
+                    return FALL_THROUGH
+                bbid = id - cfg.user.id_offset
+
+                if self.users and self.users.loaded:
+                    name = self.users.name(bbid)
+                    if name is None or name == 'SuperUser':
+                        debug('idToName %d -> ? (snapshot)', id)
+                        return FALL_THROUGH
+                    debug('idToName %d -> "%s" (snapshot)', id, name)
+                    return name
+
+                # Fetch the user from the database
+                try:
+                    cur = threadDB.execute(backend.sql['id_to_name'], [bbid])
+                except threadDbException:
+                    return FALL_THROUGH
+
+                res = cur.fetchone()
+                cur.close()
+                if res:
+                    if res[0] == 'SuperUser':
+                        debug('idToName %d -> "SuperUser" catched', id)
+                        return FALL_THROUGH
+
+                    debug('idToName %d -> "%s"', id, res[0])
+                    return res[0]
+
+                debug('idToName %d -> ?', id)
+                return FALL_THROUGH
+
+            @fortifyIceFu("")
+            @checkSecret
+            def idToTexture(self, id, current = None):
+                """
+                Gets called to get the corresponding texture for a user
+                """
+
+                FALL_THROUGH = ""
+
+                debug('idToTexture for %d', id)
+                if id < cfg.user.id_offset or not cfg.user.avatar_enable:
+                    debug('idToTexture %d -> fall through', id)
+                    return FALL_THROUGH
+
+                # Otherwise get the users texture from the forum
+                bbid = id - cfg.user.id_offset
+                if self.prefetcher:
+                    # Never block on a download, answer from memory or fall through
+                    texture = self.prefetcher.lookup(bbid)
+                    if texture is None:
+                        debug('idToTexture %d -> not prefetched yet, fall through', id)
+                        return FALL_THROUGH
+                    return texture
+
+                try:
+                    avatar_file = backend.fetch_avatar(bbid)
+                except threadDbException:
+                    return FALL_THROUGH
+
+                if not avatar_file:
+                    debug('idToTexture %d -> fall through', id)
+                    return FALL_THROUGH
+
+                try:
+                    return self.texture_cache.retrieve(avatar_file)
+                except (URLError, IOError, OSError) as e:
+                    warning('Image download for "%s" (%d) failed: %s', avatar_file, id, str(e))
+                    return FALL_THROUGH
+
+            @fortifyIceFu(-2)
+            @checkSecret
+            def registerUser(self, name, current = None):
+                """
+                Gets called when the server is asked to register a user.
+                """
+
+                FALL_THROUGH = -2
+                debug('registerUser "%s" -> fall through', name)
+                return FALL_THROUGH
+
+            @fortifyIceFu(-1)
+            @checkSecret
+            def unregisterUser(self, id, current = None):
+                """
+                Gets called when the server is asked to unregister a user.
+                """
+
+                FALL_THROUGH = -1
+                # Return -1 to fall through to internal server database, we will not modify the forum database
+                # but we can make murmur delete all additional information it got this way.
+                debug('unregisterUser %d -> fall through', id)
+                return FALL_THROUGH
+
+            @fortifyIceFu({})
+            @checkSecret
+            def getRegisteredUsers(self, filter, current = None):
+                """
+                Returns a list of usernames in the forum database which contain
+                filter as a substring.
+                """
+
+                if not filter:
+                    filter = '%'
+
+                if self.users and self.users.loaded:
+                    res = self.users.filter(filter, cfg.user.snapshot_max_results)
+                    debug('getRegisteredUsers -> %d results for filter "%s" (snapshot)', len(res), filter)
+                    return dict([(a + cfg.user.id_offset, b) for a,b in res])
+
+                try:
+                    cur = threadDB.execute(backend.sql['registered_users'], [filter])
+                except threadDbException:
+                    return {}
+
+                res = cur.fetchall()
+                cur.close()
+                if not res:
+                    debug('getRegisteredUsers -> empty list for filter "%s"', filter)
+                    return {}
+                debug ('getRegisteredUsers -> %d results for filter "%s"', len(res), filter)
+                return dict([(a + cfg.user.id_offset, b) for a,b in res])
+
+            @fortifyIceFu(-1)
+            @checkSecret
+            def setInfo(self, id, info, current = None):
+                """
+                Gets called when the server is supposed to save additional information
+                about a user to his database
+                """
+
+                FALL_THROUGH = -1
+                # Return -1 to fall through to the internal server handler. We must not modify
+                # the forum database so the additional information is stored in murmurs database
+                debug('setInfo %d -> fall through', id)
+                return FALL_THROUGH
+
+            @fortifyIceFu(-1)
+            @checkSecret
+            def setTexture(self, id, texture, current = None):
+                """
+                Gets called when the server is asked to update the user texture of a user
+                """
+
+                FAILED = 0
+                FALL_THROUGH = -1
+
+                if id < cfg.user.id_offset:
+                    debug('setTexture %d -> fall through', id)
+                    return FALL_THROUGH
+
+                if cfg.user.avatar_enable:
+                    # Report a fail (0) as we will not update the avatar in the forum database.
+                    debug('setTexture %d -> failed', id)
+                    return FAILED
+
+                # If we don't use textures from the forum we let mumble save it
+                debug('setTexture %d -> fall through', id)
+                return FALL_THROUGH
+
+        return forumAuthenticator()
+    return make_authenticator
+
+#
+#--- Ice side
+#
+def ice_host(host):
+    """
+    Quotes IPv6 addresses for use in endpoint strings, where a colon
+    separates endpoints
+    """
+    if ':' in host:
+        return '"%s"' % host
+    return host
+
+def serve(title, module, make_authenticator):
+    """
+    Connects to Murmur and serves an authenticator till we are stopped.
+    module names the module the slice file defines (Murmur or MumbleServer),
+    make_authenticator(M, fortifyIceFu, checkSecret) is handed that module
+    and the decorators every callback has to go through and returns the
+    servant. Its start() is called before connecting, stop() on shutdown.
+
+    All of this has to run after daemonizing so the file descriptors
+    opened by the Ice module are not lost.
+    """
+    slicedir = Ice.getSliceDir()
+    if not slicedir:
+        slicedir = ["-I/usr/share/Ice/slice", "-I/usr/share/slice"]
+    else:
+        slicedir = ['-I' + slicedir]
+    Ice.loadSlice('', slicedir + [cfg.ice.slice])
+    M = __import__(module)
+    invalid_secret = module + '::InvalidSecretException'
+
+    class authenticatorApp(Ice.Application):
+        def __init__(self, authenticator):
+            Ice.Application.__init__(self)
+            self.authenticator = authenticator
+            self.links = []
+
+        def run(self, args):
+            self.shutdownOnInterrupt()
+            self.authenticator.start()
+            exporter = statsExporter(cfg.stats.host, cfg.stats.port, cfg.stats.file, cfg.stats.interval)
+
+            if not self.initializeIceConnection():
+                self.authenticator.stop()
+                exporter.stop()
+                return 1
+
+            if cfg.ice.watchdog > 0:
+                for link in self.links:
+                    link.start()
+
+            # Serve till we are stopped
+            self.communicator().waitForShutdown()
+            for link in self.links:
+                link.stop()
+
+            if self.interrupted():
+                warning('Caught interrupt, shutting down')
+
+            self.authenticator.stop()
+            exporter.stop()
+            return 0
+
+        def initializeIceConnection(self):
+            """
+            Establishes the two-way Ice connections and adds the authenticator to the
+            configured servers of every Murmur. All of them share the one servant
+            and with it the connection pool, caches and workers.
+            """
+            ice = self.communicator()
+
+            if cfg.ice.secret:
+                debug('Using shared ice secret')
+                ice.getImplicitContext().put("secret", cfg.ice.secret)
+            elif not cfg.glacier.enabled:
+                warning('Consider using an ice secret to improve security')
+
+            if cfg.glacier.enabled:
+                #info('Connecting to Glacier2 server (%s:%d)', glacier_host, glacier_port)
+                error('Glacier support not implemented yet')
+                #TODO: Implement this
+
+            adapter = ice.createObjectAdapterWithEndpoints('Callback.Client', 'tcp -h %s' % ice_host(cfg.ice.callback_host or cfg.ice.host))
+            adapter.activate()
+
+            authprx = adapter.addWithUUID(self.authenticator)
+            self.auth = M.ServerUpdatingAuthenticatorPrx.uncheckedCast(authprx)
+
+            for host, port in cfg.ice.endpoints or [(cfg.ice.host, cfg.ice.port)]:
+                link = murmurLink(self, adapter, host, port)
+                info('Connecting to Ice server (%s)', link.name)
+                try:
+                    link.attachCallbacks()
+                except Ice.Exception as e:
+                    # Left to the reconnect thread like any other lost server
+                    warning('Could not connect to Ice server (%s): %s', link.name, str(e))
+                    link.connected = False
+                    call_stats.murmur(link.name, False)
+                self.links.append(link)
+
+            # Servers missing at startup are retried along with the ones lost later,
+            # but if none of them is there the configuration is most likely wrong
+            for link in self.links:
+                if link.connected:
+                    return True
+            return False
+
+    if hasattr(Ice, 'ConnectionCallback'):
+        class connectionCallback(Ice.ConnectionCallback):
+            """
+            Ice 3.6 reports closed connections to a callback object
+            """
+
+            def __init__(self, link):
+                Ice.ConnectionCallback.__init__(self)
+                self.link = link
+
+            def heartbeat(self, connection):
+                pass
+
+            def closed(self, connection):
+                self.link.closed(connection)
+    else:
+        connectionCallback = None
+
+    class murmurLink(object):
+        """
+        Connection to the Meta object of one Murmur server. The callbacks are
+        attached once and again only after Ice reported the connection closed
+        (setCloseCallback in Ice 3.7, setCallback in Ice 3.6), retrying with
+        exponential backoff up to cfg.ice.reconnect_max seconds. Heartbeats
+        keep the connection open. A restarted server resets the connection
+        on the next heartbeat, one that vanished without a word is only
+        noticed once TCP gives up retransmitting them (tcp_retries2, about
+        15 minutes on Linux). Without close callbacks the connection is
+        checked every cfg.ice.watchdog seconds instead.
+        """
+
+        def __init__(self, app, adapter, host, port):
+            self.app = app
+            if ':' in host:
+                self.name = '[%s]:%d' % (host, port)
+            else:
+                self.name = '%s:%d' % (host, port)
+
+            base = app.communicator().stringToProxy('Meta:tcp -h %s -p %d' % (ice_host(host), port))
+            self.meta = M.MetaPrx.uncheckedCast(base)
+
+            metacbprx = adapter.addWithUUID(metaCallback(self))
+            self.metacb = M.MetaCallbackPrx.uncheckedCast(metacbprx)
+
+            self.lock = Condition()
+            self.connected = False
+            self.connection = None # The one we get close callbacks for
+            self.polling = False # No close callbacks, check every cfg.ice.watchdog seconds
+            self.stopping = False
+
+        def attachCallbacks(self, quiet = False):
+            """
+            Attaches all callbacks for meta and authenticators
+            """
+
+            # Ice.ConnectionRefusedException
+            #debug('Attaching callbacks')
+            try:
+                if not quiet: info('Attaching meta callback (%s)', self.name)
+
+                self.meta.addCallback(self.metacb)
+
+                for server in self.meta.getBootedServers():
+                    if not cfg.murmur.servers or server.id() in cfg.murmur.servers:
+                        if not quiet: info('Setting authenticator for virtual server %d (%s)', server.id(), self.name)
+                        server.setAuthenticator(self.app.auth)
+
+            except (M.InvalidSecretException, Ice.UnknownUserException, Ice.ConnectionRefusedException) as e:
+                if isinstance(e, Ice.ConnectionRefusedException):
+                    error('Server refused connection')
+                elif isinstance(e, M.InvalidSecretException) or \
+                     isinstance(e, Ice.UnknownUserException) and (e.unknown == invalid_secret):
+                    error('Invalid ice secret')
+                else:
+                    # We do not actually want to handle this one, re-raise it
+                    raise e
+
+                self.connected = False
+                call_stats.murmur(self.name, False)
+                return False
+
+            self.connected = True
+            call_stats.murmur(self.name, True)
+            return True
+
+        def watch(self):
+            """
+            Asks Ice to report the close of the connection the callbacks were
+            attached over. Returns False if it is gone already.
+            """
+            try:
+                connection = self.meta.ice_getConnection()
+            except Ice.Exception as e:
+                debug(str(e))
+                return False
+
+            if not hasattr(connection, 'setCloseCallback') and \
+               not (hasattr(connection, 'setCallback') and connectionCallback):
+                if not self.polling:
+                    info('Ice %s can not report closed connections, checking the connection every %ds',
+                         Ice.stringVersion(), cfg.ice.watchdog)
+                    self.polling = True
+                return True
+
+            self.lock.acquire()
+            try:
+                self.connection = connection
+            finally:
+                self.lock.release()
+
+            # Called right away if the connection closed in the meantime
+            if hasattr(connection, 'setCloseCallback'):
+                connection.setCloseCallback(self.closed)
+            else:
+                connection.setCallback(connectionCallback(self))
+            # CloseOff, the other modes would also close a healthy connection
+            # Murmur just has nothing to say on
+            connection.setACM(cfg.ice.watchdog, Ice.ACMClose.CloseOff, Ice.ACMHeartbeat.HeartbeatAlways)
+            return True
+
+        def closed(self, connection):
+            self.lost(connection)
+
+        def lost(self, connection = None):
+            """
+            Marks the callbacks as detached and wakes the reconnect thread.
+            Close reports of connections we already replaced are ignored.
+            """
+            self.lock.acquire()
+            try:
+                if connection is not None and connection != self.connection:
+                    return
+                if self.connected:
+                    warning('Lost connection to Ice server (%s)', self.name)
+                self.connected = False
+                call_stats.murmur(self.name, False)
+                self.lock.notify()
+            finally:
+                self.lock.release()
+
+        def start(self):
+            if not self.watch():
+                self.lost()
+
+            worker = Thread(target = self.work, name = 'Reconnect-%s' % self.name)
+            worker.daemon = True
+            worker.start()
+
+        def stop(self):
+            self.lock.acquire()
+            try:
+                self.stopping = True
+                self.lock.notify()
+            finally:
+                self.lock.release()
+
+        def wait(self, timeout = None):
+            """
+            Blocks till the callbacks have to be attached again, at most timeout
+            seconds. Returns False once we are stopping.
+            """
+            self.lock.acquire()
+            try:
+                if timeout is not None:
+                    if not self.stopping:
+                        self.lock.wait(timeout)
+                else:
+                    while self.connected and not self.stopping:
+                        self.lock.wait()
+                return not self.stopping
+            finally:
+                self.lock.release()
+
+        def work(self):
+            delay = 1
+            while True:
+                if self.polling and self.connected:
+                    if not self.wait(cfg.ice.watchdog):
+                        return
+                elif not self.wait():
+                    return
+
+                reconnect = not self.connected
+                try:
+                    attached = self.attachCallbacks(quiet = not reconnect)
+                except Ice.Exception as e:
+                    debug(str(e))
+                    attached = False
+
+                if attached and self.watch():
+                    if reconnect:
+                        info('Reattached to Ice server (%s)', self.name)
+                        call_stats.murmur(self.name, True, reconnect = True)
+                    delay = 1
+                    continue
+
+                if not reconnect:
+                    # Only noticed by the periodic check
+                    warning('Lost connection to Ice server (%s)', self.name)
+                self.connected = False
+                call_stats.murmur(self.name, False)
+                error('Could not attach to Ice server (%s), retrying in %ds', self.name, delay)
+                if not self.wait(delay):
+                    return
+                delay = min(delay * 2, cfg.ice.reconnect_max)
+
+    def checkSecret(func):
+        """
+        Decorator that checks whether the server transmitted the right secret
+        if a secret is supposed to be used.
+        """
+        if not cfg.ice.secret:
+            return func
+
+        def newfunc(*args, **kws):
+            if 'current' in kws:
+                current = kws["current"]
+            else:
+                current = args[-1]
+
+            if not current or 'secret' not in current.ctx or current.ctx['secret'] != cfg.ice.secret:
+                error('Server transmitted invalid secret. Possible injection attempt.')
+                raise M.InvalidSecretException()
+
+            return func(*args, **kws)
+
+        # Statistics are kept by the name of the callback
+        newfunc.__name__ = func.__name__
+        return newfunc
+
+    def fortifyIceFu(retval = None, exceptions = (Ice.Exception,)):
+        """
+        Decorator that catches exceptions,logs them and returns a safe retval
+        value. This helps preventing the authenticator getting stuck in
+        critical code paths. Only exceptions that are instances of classes
+        given in the exceptions list are not caught. The latency and outcome
+        of every call is added to the statistics.
+
+        The default is to catch all non-Ice exceptions.
+        """
+        def newdec(func):
+            def newfunc(*args, **kws):
+                start = time.time()
+                outcome = 'error'
+                try:
+                    result = func(*args, **kws)
+                    outcome = call_outcome(func.__name__, result, retval)
+                    return result
+                except Exception as e:
+                    catch = True
+                    for ex in exceptions:
+                        if isinstance(e, ex):
+                            catch = False
+                            break
+
+                    if catch:
+                        critical('Unexpected exception caught')
+                        exception(e)
+                        return retval
+                    raise
+                finally:
+                    call_stats.call(func.__name__, outcome, time.time() - start)
+
+            return newfunc
+        return newdec
+
+    class metaCallback(M.MetaCallback):
+        def __init__(self, link):
+            M.MetaCallback.__init__(self)
+            self.link = link
+
+        @fortifyIceFu()
+        @checkSecret
+        def started(self, server, current = None):
+            """
+            This function is called when a virtual server is started
+            and makes sure an authenticator gets attached if needed.
+            """
+            if not cfg.murmur.servers or server.id() in cfg.murmur.servers:
+                info('Setting authenticator for virtual server %d (%s)', server.id(), self.link.name)
+                try:
+                    server.setAuthenticator(self.link.app.auth)
+                # Apparently this server was restarted without us noticing
+                except (M.InvalidSecretException, Ice.UnknownUserException) as e:
+                    if hasattr(e, "unknown") and e.unknown != invalid_secret:
+                        # Special handling for Murmur 1.2.2 servers with invalid slice files
+                        raise e
+
+                    error('Invalid ice secret')
+                    return
+            else:
+                debug('Virtual server %d got started (%s)', server.id(), self.link.name)
+
+        @fortifyIceFu()
+        @checkSecret
+        def stopped(self, server, current = None):
+            """
+            This function is called when a virtual server is stopped
+            """
+            if self.link.connected:
+                # Only try to output the server id if we think we are still connected to prevent
+                # flooding of our thread pool
+                try:
+                    if not cfg.murmur.servers or server.id() in cfg.murmur.servers:
+                        info('Authenticated virtual server %d got stopped (%s)', server.id(), self.link.name)
+                    else:
+                        debug('Virtual server %d got stopped (%s)', server.id(), self.link.name)
+                    return
+                except Ice.ConnectionRefusedException:
+                    self.link.lost()
+
+            debug('Server shutdown stopped a virtual server')
+
+    class CustomLogger(Ice.Logger):
+        """
+        Logger implementation to pipe Ice log messages into
+        our own log
+        """
+
+        def __init__(self):
+            Ice.Logger.__init__(self)
+            self._log = getLogger('Ice')
+
+        def _print(self, message):
+            self._log.info(message)
+
+        def trace(self, category, message):
+            self._log.debug('Trace %s: %s', category, message)
+
+        def warning(self, message):
+            self._log.warning(message)
+
+        def error(self, message):
+            self._log.error(message)
+
+    authenticator = make_authenticator(M, fortifyIceFu, checkSecret)
+
+    #
+    #--- Start of authenticator
+    #
+    info('Starting %s mumble authenticator', title)
+    initdata = Ice.InitializationData()
+    initdata.properties = Ice.createProperties([], initdata.properties)
+    for prop, val in cfg.iceraw:
+        initdata.properties.setProperty(prop, val)
+
+    initdata.properties.setProperty('Ice.ImplicitContext', 'Shared')
+    initdata.properties.setProperty('Ice.Default.EncodingVersion', '1.0')
+    initdata.logger = CustomLogger()
+
+    app = authenticatorApp(authenticator)
+    state = app.main(sys.argv[:1], initData = initdata)
+    info('Shutdown complete')
+    return state
+
+#
+#--- Start of program
+#
+def setup(cfgfile, default, name):
+    """
+    Parses the command line, loads the configuration and, if it has a
+    database section, the database library and sets up logging. name
+    prefixes the statistics. Returns the configuration.
+    """
+    global cfg, db, options
+
+    # Parse commandline options
+    parser = OptionParser()
+    parser.add_option('-i', '--ini',
+                      help = 'load configuration from INI', default = cfgfile)
+    parser.add_option('-v', '--verbose', action='store_true', dest = 'verbose',
+                      help = 'verbose output [default]', default = True)
+    parser.add_option('-q', '--quiet', action='store_false', dest = 'verbose',
+                      help = 'only error output')
+    parser.add_option('-d', '--daemon', action='store_true', dest = 'force_daemon',
+                      help = 'run as daemon', default = False)
+    parser.add_option('-a', '--app', action='store_true', dest = 'force_app',
+                      help = 'do not run as daemon', default = False)
+    (options, args) = parser.parse_args()
+
+    if options.force_daemon and options.force_app:
+        parser.print_help()
+        sys.exit(1)
+
+    # Load configuration
+    try:
+        cfg = config(options.ini, default)
+    except Exception as e:
+        sys.stderr.write('Fatal error, could not load config file from "%s"\n' % options.ini)
+        sys.exit(1)
+
+    if 'database' in default:
+        try:
+            db = __import__(cfg.database.lib)
+        except ImportError as e:
+            sys.stderr.write('Fatal error, could not import database library "%s", '\
+            'please install the missing dependency and restart the authenticator\n' % cfg.database.lib)
+            sys.exit(1)
+
+    call_stats.prefix = name
+
+    # Initialize logger
+    if cfg.log.file:
+        try:
+            options.logfile = open(cfg.log.file, 'a')
+        except IOError as e:
+            sys.stderr.write('Fatal error, could not open logfile "%s"\n' % cfg.log.file)
+            sys.exit(1)
+    else:
+        options.logfile = logging.sys.stderr
+
+    if options.verbose:
+        level = cfg.log.level
+    else:
+        level = logging.ERROR
+
+    logging.basicConfig(level = level,
+                        format='%(asctime)s %(levelname)s %(message)s',
+                        stream = options.logfile)
+    return cfg
+
+def launch(program):
+    """
+    Runs program as a daemon if possible, see setup() for the options
+    """
+    # As the default try to run as daemon. Silently degrade to running as a normal application if this fails
+    # unless the user explicitly defined what he expected with the -a / -d parameter.
+    try:
+        if options.force_app:
+            raise ImportError # Pretend that we couldn't import the daemon lib
+        import daemon
+    except ImportError:
+        if options.force_daemon:
+            sys.stderr.write('Fatal error, could not daemonize process due to missing "daemon" library, ' \
+            'please install the missing dependency and restart the authenticator\n')
+            sys.exit(1)
+        program()
+    else:
+        context = daemon.DaemonContext(working_directory = sys.path[0],
+                                       stderr = options.logfile)
+        context.__enter__()
+        try:
+            program()
+        finally:
+            context.__exit__(None, None, None)
@@ -0,0 +1,1010 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+# Copyright (C) 2026 The Mumble Developers
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+# - Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# - Neither the name of the Mumble Developers nor the names of its
+#   contributors may be used to endorse or promote products derived from this
+#   software without specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# `AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL THE FOUNDATION OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+#
+#    loadtest.py - Offline load test for the authenticators
+#
+#    Runs one of phpBB3auth.py, SMF/1.x/smfauth.py, SMF/2.0/smfauth.py,
+#    elkarteauth.py or LDAPauth.py unmodified in a child process and plays
+#    Murmur for it: the authenticator connects to a stand-in Meta/Server
+#    served on a local Ice adapter, registers itself and is then called by
+#    a configurable number of threads with a mix of authenticate, nameToId,
+#    idToName and getRegisteredUsers requests. Latency percentiles and
+#    throughput are reported per call type.
+#
+#    The forum authenticators run against a generated SQLite database, this
+#    module doubles as the MySQLdb replacement selected by [database] lib.
+#    LDAPauth.py gets an in-process stand-in for the ldap module serving a
+#    generated directory. Everything stays on the local machine.
+#
+#    Example:
+#        python loadtest.py -u 5000 -n 20000 -c 20 --distribution zipf \
+#               --slice /usr/share/slice/Murmur.ice phpBB3/phpBB3auth.py
+#
+#    Requirements:
+#        * python >=2.7 and ice-python for the harness itself
+#        * whatever the authenticator under test needs, besides its database
+#          or directory server (bcrypt, ...)
+#
+
+from __future__ import print_function
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import shutil
+import socket
+import sqlite3
+import hashlib
+import bisect
+import tempfile
+import threading
+import subprocess
+
+from optparse import OptionParser
+
+try:
+    import ConfigParser
+except ImportError:
+    import configparser as ConfigParser
+
+try:
+    xrange
+except NameError:
+    xrange = range
+
+try:
+    unicode
+except NameError:
+    unicode = str
+
+# Seconds every database query or directory operation is delayed by to
+# emulate a server that is not on the same machine
+backend_latency = float(os.environ.get('LOADTEST_BACKEND_LATENCY', '0'))
+
+#
+#--- MySQLdb compatible database module over sqlite3
+#    Selected in the authenticator with [database] lib = loadtest, name is
+#    the path of the database file. Only what the authenticators use exists.
+#
+Error = sqlite3.Error
+OperationalError = sqlite3.OperationalError
+
+def find_in_set(needle, haystack):
+    """
+    MySQL's FIND_IN_SET: 1 based position of needle in a comma separated
+    list, 0 if it is missing
+    """
+    if needle is None or haystack is None:
+        return None
+    try:
+        return [s.strip() for s in unicode(haystack).split(',')].index(unicode(needle)) + 1
+    except ValueError:
+        return 0
+
+group_concat_separator = re.compile(r"GROUP_CONCAT\((.+?) SEPARATOR '((?:[^']|\\')*)'\)")
+
+def sqlite_statement(statement):
+    """
+    Translates a MySQLdb style statement to sqlite3
+    """
+    def separator(match):
+        if match.group(2) == '\\n':
+            return 'GROUP_CONCAT(%s, char(10))' % match.group(1)
+        return "GROUP_CONCAT(%s, '%s')" % (match.group(1), match.group(2))
+    return group_concat_separator.sub(separator, statement).replace('%s', '?')
+
+def sqlite_argument(value):
+    if isinstance(value, bytes) and bytes is str:
+        # Python 2 byte strings from the authenticators are UTF-8
+        return value.decode('utf-8')
+    return value
+
+class sqliteCursor(object):
+    statements = {}
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, statement, args = None):
+        if statement.startswith('SET SESSION '):
+            # sqlite has no session variables and no GROUP_CONCAT limit
+            return 0
+        if backend_latency:
+            time.sleep(backend_latency)
+        translated = self.statements.get(statement)
+        if translated is None:
+            translated = self.statements[statement] = sqlite_statement(statement)
+        if args is None:
+            args = ()
+        elif not isinstance(args, (list, tuple)):
+            args = (args,)
+        self.cursor.execute(translated, [sqlite_argument(a) for a in args])
+        return self.cursor.rowcount
+
+    def _get_description(self):
+        return self.cursor.description
+    description = property(_get_description)
+
+    def _get_rowcount(self):
+        return self.cursor.rowcount
+    rowcount = property(_get_rowcount)
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def close(self):
+        self.cursor.close()
+
+class sqliteConnection(object):
+    def __init__(self, filename):
+        # Pooled connections are opened and used by different threads,
+        # but only ever by one at a time
+        self.con = sqlite3.connect(filename, check_same_thread = False, isolation_level = None)
+        self.con.create_function('FIND_IN_SET', 2, find_in_set)
+
+    def autocommit(self, on):
+        self.con.isolation_level = None if on else ''
+
+    def ping(self, *args):
+        self.con.execute('SELECT 1')
+
+    def cursor(self):
+        return sqliteCursor(self.con.cursor())
+
+    def commit(self):
+        self.con.commit()
+
+    def close(self):
+        self.con.close()
+
+def connect(host = None, port = None, user = None, passwd = None, db = None, charset = None, **kwargs):
+    if not db or not os.path.exists(db):
+        raise OperationalError('no database file %r' % db)
+    return sqliteConnection(db)
+
+#
+#--- Stand-in for the python-ldap module used by LDAPauth.py
+#    Serves the directory the harness wrote to LOADTEST_DIRECTORY. Filters
+#    support the (&...), (|...), (!...), =, >= and * substring forms.
+#
+class stubLDAPError(Exception):
+    pass
+
+ldap_errors = ['SERVER_DOWN', 'CONNECT_ERROR', 'TIMEOUT', 'INVALID_CREDENTIALS',
+               'NO_SUCH_OBJECT', 'DECODING_ERROR', 'FILTER_ERROR']
+
+ldap_constants = {'SCOPE_BASE': 0, 'SCOPE_ONELEVEL': 1, 'SCOPE_SUBTREE': 2,
+                  'RES_ANY': -1, 'RES_SEARCH_ENTRY': 100, 'RES_SEARCH_RESULT': 101,
+                  'OPT_PROTOCOL_VERSION': 0x11, 'OPT_NETWORK_TIMEOUT': 0x5005,
+                  'OPT_TIMEOUT': 0x5002, 'OPT_X_TLS': 0x6000, 'OPT_X_TLS_DEMAND': 2,
+                  'OPT_X_TLS_NEVER': 0, 'OPT_X_TLS_REQUIRE_CERT': 0x6006}
+
+def dn_parts(dn):
+    return [part.strip().lower() for part in dn.split(',') if part.strip()]
+
+def str2dn(dn, flags = 0):
+    rdns = []
+    for part in dn.split(','):
+        if '=' not in part:
+            raise stubDirectory.module.DECODING_ERROR(dn)
+        attr, value = part.split('=', 1)
+        rdns.append([(attr.strip(), value.strip(), 1)])
+    return rdns
+
+def dn2str(rdns):
+    return ','.join('+'.join('%s=%s' % (attr, value) for attr, value, flags in rdn) for rdn in rdns)
+
+def parse_filter(text):
+    """
+    Parses an LDAP filter into nested (operator, ...) tuples
+    """
+    def parse(pos):
+        if text[pos] != '(':
+            raise stubDirectory.module.FILTER_ERROR(text)
+        op = text[pos + 1]
+        if op in '&|!':
+            children = []
+            pos += 2
+            while text[pos] == '(':
+                child, pos = parse(pos)
+                children.append(child)
+            return (op, children), pos + 1
+        end = text.index(')', pos)
+        item = text[pos + 1:end]
+        if '>=' in item:
+            attr, value = item.split('>=', 1)
+            return ('>=', attr.lower(), value.lower()), end + 1
+        if '<=' in item:
+            attr, value = item.split('<=', 1)
+            return ('<=', attr.lower(), value.lower()), end + 1
+        attr, value = item.split('=', 1)
+        if value == '*':
+            return ('present', attr.lower()), end + 1
+        if '*' in value:
+            pattern = '.*'.join(re.escape(p) for p in value.lower().split('*'))
+            return ('like', attr.lower(), re.compile('^' + pattern + '$')), end + 1
+        return ('=', attr.lower(), value.lower()), end + 1
+
+    parsed, pos = parse(0)
+    return parsed
+
+def match_filter(parsed, attrs):
+    op = parsed[0]
+    if op == '&':
+        return all(match_filter(child, attrs) for child in parsed[1])
+    if op == '|':
+        return any(match_filter(child, attrs) for child in parsed[1])
+    if op == '!':
+        return not match_filter(parsed[1][0], attrs)
+    values = attrs.get(parsed[1], ())
+    if op == 'present':
+        return bool(values)
+    if op == 'like':
+        return any(parsed[2].match(v) for v in values)
+    if op == '>=':
+        return any(v >= parsed[2] for v in values)
+    if op == '<=':
+        return any(v <= parsed[2] for v in values)
+    return parsed[2] in values
+
+class stubPagedResultsControl(object):
+    controlType = '1.2.840.113556.1.4.319'
+
+    def __init__(self, criticality = False, size = 0, cookie = ''):
+        self.criticality = criticality
+        self.size = size
+        self.cookie = cookie
+
+class stubDirectory(object):
+    """
+    Directory loaded from the JSON written by the harness, shared by all
+    connections. Entries keep the attribute names as given for results and
+    lower cased values for matching.
+    """
+    module = None
+    entries = None
+    passwords = {}
+
+    def load(cls, filename):
+        cls.entries = []
+        with open(filename) as f:
+            for dn, attrs in json.load(f):
+                lowered = dict((name.lower(), [v.lower() for v in values]) for name, values in attrs.items())
+                cls.entries.append((dn, dn_parts(dn), attrs, lowered))
+                if 'userPassword' in attrs:
+                    cls.passwords[','.join(dn_parts(dn))] = attrs['userPassword'][0]
+    load = classmethod(load)
+
+    def search(cls, base, scope, filterstr, attrlist):
+        base = dn_parts(base)
+        parsed = parse_filter(filterstr)
+        results = []
+        for dn, parts, attrs, lowered in cls.entries:
+            if scope == 0 and parts != base:
+                continue
+            if parts[len(parts) - len(base):] != base:
+                continue
+            if scope == 1 and len(parts) != len(base) + 1:
+                continue
+            if not match_filter(parsed, lowered):
+                continue
+            if attrlist:
+                wanted = dict((name.lower(), name) for name in attrlist)
+                selected = dict((wanted[name.lower()], values) for name, values in attrs.items() if name.lower() in wanted)
+            else:
+                selected = dict(attrs)
+            selected.pop('userPassword', None)
+            results.append((dn, dict((name, [v.encode('utf-8') for v in values]) for name, values in selected.items())))
+        return results
+    search = classmethod(search)
+
+class stubConnection(object):
+    def __init__(self, uri):
+        self.uri = uri
+        self.timeout = -1
+        self.lock = threading.Condition()
+        self.messages = []
+        self.msgid = 0
+
+    def set_option(self, option, value):
+        pass
+
+    def start_tls_s(self):
+        pass
+
+    def simple_bind_s(self, who = None, cred = None):
+        if backend_latency:
+            time.sleep(backend_latency)
+        if not who:
+            return
+        expected = stubDirectory.passwords.get(','.join(dn_parts(who)))
+        # Service accounts are not part of the generated directory
+        if expected is not None and expected != cred:
+            raise stubDirectory.module.INVALID_CREDENTIALS({'desc': 'Invalid credentials'})
+
+    def whoami_s(self):
+        return ''
+
+    def search_s(self, base, scope, filterstr = '(objectClass=*)', attrlist = None, attrsonly = 0):
+        if backend_latency:
+            time.sleep(backend_latency)
+        return stubDirectory.search(base, scope, filterstr, attrlist)
+
+    def search_ext(self, base, scope, filterstr = '(objectClass=*)', attrlist = None, attrsonly = 0, serverctrls = None, **kwargs):
+        results = self.search_s(base, scope, filterstr, attrlist)
+        controls = []
+        for control in serverctrls or []:
+            if control.controlType == stubPagedResultsControl.controlType and control.size:
+                offset = int(control.cookie or 0)
+                if offset + control.size < len(results):
+                    controls.append(stubPagedResultsControl(False, control.size, str(offset + control.size)))
+                results = results[offset:offset + control.size]
+
+        self.lock.acquire()
+        try:
+            self.msgid += 1
+            for entry in results:
+                self.messages.append((ldap_constants['RES_SEARCH_ENTRY'], [entry], self.msgid, []))
+            self.messages.append((ldap_constants['RES_SEARCH_RESULT'], [], self.msgid, controls))
+            self.lock.notify_all()
+            return self.msgid
+        finally:
+            self.lock.release()
+
+    def result3(self, msgid = -1, all = 1, timeout = None):
+        self.lock.acquire()
+        try:
+            if all:
+                entries = [m for m in self.messages if m[2] == msgid and m[0] != ldap_constants['RES_SEARCH_RESULT']]
+                final = [m for m in self.messages if m[2] == msgid and m[0] == ldap_constants['RES_SEARCH_RESULT']]
+                self.messages = [m for m in self.messages if m[2] != msgid]
+                return (ldap_constants['RES_SEARCH_RESULT'], [e[1][0] for e in entries], msgid, final[0][3] if final else [])
+            deadline = None if timeout is None or timeout < 0 else time.time() + timeout
+            while True:
+                for i, message in enumerate(self.messages):
+                    if msgid == -1 or message[2] == msgid:
+                        del self.messages[i]
+                        return message
+                if deadline is not None and time.time() >= deadline:
+                    raise stubDirectory.module.TIMEOUT({'desc': 'Timed out'})
+                self.lock.wait(None if deadline is None else max(0, deadline - time.time()))
+        finally:
+            self.lock.release()
+
+    def abandon(self, msgid):
+        self.lock.acquire()
+        try:
+            self.messages = [m for m in self.messages if m[2] != msgid]
+        finally:
+            self.lock.release()
+
+    def unbind_s(self):
+        pass
+    unbind = unbind_s
+
+def ldap_modules(filename):
+    """
+    Builds the ldap, ldap.dn and ldap.controls stand-in modules
+    """
+    import types
+    stubDirectory.load(filename)
+
+    module = types.ModuleType('ldap')
+    module.LDAPError = stubLDAPError
+    for name in ldap_errors:
+        setattr(module, name, type(name, (stubLDAPError,), {}))
+    for name, value in ldap_constants.items():
+        setattr(module, name, value)
+    module.initialize = lambda uri, trace_level = 0, **kwargs: stubConnection(uri)
+    module.set_option = lambda option, value: None
+    stubDirectory.module = module
+
+    module.dn = types.ModuleType('ldap.dn')
+    module.dn.str2dn = str2dn
+    module.dn.dn2str = dn2str
+    module.controls = types.ModuleType('ldap.controls')
+    module.controls.SimplePagedResultsControl = stubPagedResultsControl
+    return {'ldap': module, 'ldap.dn': module.dn, 'ldap.controls': module.controls}
+
+#
+#--- Test data
+#
+itoa64 = './0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+
+def phpass_hash(password, cost):
+    """
+    phpBB3 salted md5 ($H$) hash of password
+    """
+    salt = ''.join([itoa64[c & 0x3f] for c in bytearray(os.urandom(8))])
+    password = password.encode('utf-8')
+    hash = hashlib.md5(salt.encode('ascii') + password).digest()
+    for i in xrange(1 << cost):
+        hash = hashlib.md5(hash + password).digest()
+
+    data = bytearray(hash)
+    output = []
+    for i in xrange(0, 16, 3):
+        group = data[i:i + 3]
+        value = group[0]
+        if len(group) > 1:
+            value |= group[1] << 8
+        if len(group) > 2:
+            value |= group[2] << 16
+        for shift in xrange(0, 6 * (len(group) + 1), 6):
+            output.append(itoa64[(value >> shift) & 0x3f])
+    return '$H$' + itoa64[cost] + salt + ''.join(output)
+
+def bcrypt_hash(secret, cost):
+    import bcrypt
+    return bcrypt.hashpw(secret.encode('utf-8'), bcrypt.gensalt(cost)).decode('ascii')
+
+def sha1_hex(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+# Password schemes per authenticator: default first, with the default cost
+schemes = {'phpbb3': [('phpass', 11), ('bcrypt', 10), ('md5', 0)],
+           'smf1': [('sha1', 0)],
+           'smf2': [('sha1', 0), ('bcrypt', 10)],
+           'elkarte': [('bcrypt', 10)],
+           'ldap': [('plain', 0)]}
+
+def password_hash(kind, scheme, cost, name, password):
+    if scheme == 'phpass':
+        return phpass_hash(password, cost)
+    if scheme == 'md5':
+        return hashlib.md5(password.encode('utf-8')).hexdigest()
+    if scheme == 'sha1':
+        return sha1_hex(name.lower() + password)
+    if scheme == 'bcrypt':
+        if kind == 'phpbb3':
+            return bcrypt_hash(password, cost)
+        if kind == 'elkarte':
+            return bcrypt_hash(hashlib.sha256((name.lower() + password).encode('utf-8')).hexdigest(), cost)
+        return bcrypt_hash(name.lower() + password, cost)
+    return password
+
+def user_name(i):
+    return 'user%d' % i
+
+def user_password(i):
+    return 'secret%d' % i
+
+schema = {'phpbb3': ['CREATE TABLE %(p)susers (user_id INTEGER PRIMARY KEY, username TEXT, user_password TEXT, user_type INTEGER, user_avatar TEXT DEFAULT \'\', user_avatar_type TEXT DEFAULT \'\')',
+                     'CREATE TABLE %(p)sgroups (group_id INTEGER PRIMARY KEY, group_name TEXT)',
+                     'CREATE TABLE %(p)suser_group (group_id INTEGER, user_id INTEGER)',
+                     'CREATE INDEX %(p)suser_group_user_id ON %(p)suser_group (user_id)',
+                     'CREATE TABLE %(p)sconfig (config_name TEXT PRIMARY KEY, config_value TEXT)',
+                     "INSERT INTO %(p)sconfig VALUES ('avatar_salt', 'loadtest')",
+                     "INSERT INTO %(p)sgroups VALUES (2, 'REGISTERED')",
+                     "INSERT INTO %(p)sgroups VALUES (5, 'ADMINISTRATORS')"],
+          'smf1': ['CREATE TABLE %(p)smembers (ID_MEMBER INTEGER PRIMARY KEY, memberName TEXT, realName TEXT, passwd TEXT, ID_GROUP INTEGER, additionalGroups TEXT, is_activated INTEGER, avatar TEXT DEFAULT \'\')',
+                   'CREATE TABLE %(p)smembergroups (ID_GROUP INTEGER PRIMARY KEY, groupName TEXT)',
+                   'CREATE TABLE %(p)sattachments (ID_ATTACH INTEGER PRIMARY KEY, ID_MEMBER INTEGER, file_hash TEXT)',
+                   "INSERT INTO %(p)smembergroups VALUES (1, 'Administrator')",
+                   "INSERT INTO %(p)smembergroups VALUES (4, 'Newbie')"],
+          'smf2': ['CREATE TABLE %(p)smembers (id_member INTEGER PRIMARY KEY, member_name TEXT, real_name TEXT, passwd TEXT, id_group INTEGER, additional_groups TEXT, is_activated INTEGER, avatar TEXT DEFAULT \'\')',
+                   'CREATE TABLE %(p)smembergroups (id_group INTEGER PRIMARY KEY, group_name TEXT)',
+                   'CREATE TABLE %(p)sattachments (id_attach INTEGER PRIMARY KEY, id_member INTEGER, file_hash TEXT, filename TEXT, attachment_type INTEGER, approved INTEGER)',
+                   "INSERT INTO %(p)smembergroups VALUES (1, 'Administrator')",
+                   "INSERT INTO %(p)smembergroups VALUES (4, 'Newbie')"]}
+schema['elkarte'] = schema['smf2']
+
+def seed_database(filename, kind, prefix, users, scheme, cost):
+    """
+    Creates the forum tables the authenticator queries with users members
+    named user1.. whose passwords are secret1.., every tenth one is an
+    administrator.
+    """
+    con = sqlite3.connect(filename)
+    for statement in schema[kind]:
+        con.execute(statement % {'p': prefix})
+
+    for i in xrange(1, users + 1):
+        name = user_name(i)
+        hash = password_hash(kind, scheme, cost, name, user_password(i))
+        admin = i % 10 == 0
+        if kind == 'phpbb3':
+            con.execute('INSERT INTO %susers (user_id, username, user_password, user_type) VALUES (?, ?, ?, 0)' % prefix, (i, name, hash))
+            con.execute('INSERT INTO %suser_group VALUES (2, ?)' % prefix, (i,))
+            if admin:
+                con.execute('INSERT INTO %suser_group VALUES (5, ?)' % prefix, (i,))
+        else:
+            con.execute('INSERT INTO %smembers VALUES (?, ?, ?, ?, ?, ?, 1, \'\')' % prefix,
+                        (i, name, name.capitalize(), hash, admin and 1 or 0, '4'))
+    con.commit()
+    con.close()
+
+def seed_directory(filename, cfg, users):
+    """
+    Writes the entries of the stand-in LDAP directory: users below users_dn
+    and, when configured, the group_dn entry listing all of them.
+    """
+    def option(name, default = ''):
+        try:
+            return cfg.get('ldap', name)
+        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+            return default
+
+    users_dn = option('users_dn', 'ou=Users,dc=example,dc=com')
+    username_attr = option('username_attr', 'uid')
+    group_dn = option('group_dn')
+    group_attr = option('group_attr', 'member')
+    memberof_attr = option('memberof_attr', 'memberOf')
+
+    entries = []
+    members = []
+    for i in xrange(1, users + 1):
+        name = user_name(i)
+        dn = '%s=%s,%s' % (username_attr, name, users_dn)
+        attrs = {username_attr: [name],
+                 option('number_attr', 'roomNumber'): [str(i)],
+                 option('display_attr', 'displayName'): [name.capitalize()],
+                 option('mail_attr', 'mail'): ['%s@example.com' % name],
+                 'modifyTimestamp': ['20260101000000Z'],
+                 'userPassword': [user_password(i)]}
+        if group_dn:
+            attrs[memberof_attr] = [group_dn]
+        entries.append((dn, attrs))
+        members.append(dn)
+    if group_dn:
+        entries.append((group_dn, {group_attr: members, 'cn': [group_dn.split(',')[0].split('=')[-1]]}))
+
+    with open(filename, 'w') as f:
+        json.dump(entries, f)
+
+#
+#--- Request plan
+#
+class nameChooser(object):
+    """
+    Picks user numbers uniformly or with a zipf distribution, where user1
+    logs in most often
+    """
+    def __init__(self, rnd, users, distribution, exponent):
+        self.rnd = rnd
+        self.users = users
+        self.cumulative = None
+        if distribution == 'zipf':
+            total = 0.0
+            self.cumulative = []
+            for rank in xrange(1, users + 1):
+                total += 1.0 / rank ** exponent
+                self.cumulative.append(total)
+
+    def pick(self):
+        if self.cumulative is None:
+            return self.rnd.randint(1, self.users)
+        return bisect.bisect_left(self.cumulative, self.rnd.random() * self.cumulative[-1]) + 1
+
+def build_plan(option, id_offset):
+    """
+    Returns the list of (label, method, args) requests to send. Labels
+    separate valid, wrong password and unknown user logins in the report.
+    """
+    rnd = random.Random(option.seed)
+    chooser = nameChooser(rnd, option.users, option.distribution, option.zipf_exponent)
+
+    mix = []
+    for part in option.mix.split(','):
+        method, weight = part.split('=')
+        mix.append((method.strip(), float(weight)))
+    total = sum(weight for method, weight in mix)
+
+    plan = []
+    for n in xrange(option.requests):
+        r = rnd.random() * total
+        for method, weight in mix:
+            r -= weight
+            if r < 0:
+                break
+
+        i = chooser.pick()
+        if rnd.random() < option.unknown:
+            name, label = 'guest%d' % rnd.randint(1, 10 * option.users), 'unknown'
+        else:
+            name, label = user_name(i), 'valid'
+
+        if method == 'authenticate':
+            password = user_password(i)
+            if label == 'valid' and rnd.random() < option.wrong:
+                password, label = 'wrong' + password, 'wrong'
+            plan.append(('authenticate/' + label, method, (name, password, [], '', False)))
+        elif method == 'nameToId':
+            plan.append(('nameToId/' + label, method, (name,)))
+        elif method == 'idToName':
+            plan.append(('idToName', method, (i + id_offset,)))
+        elif method == 'getRegisteredUsers':
+            plan.append(('getRegisteredUsers', method, (user_name(i)[:rnd.randint(5, 6)],)))
+        else:
+            raise ValueError('unknown method %s in --mix' % method)
+    return plan
+
+def outcome(method, result):
+    if method == 'authenticate':
+        uid = result[0]
+    elif method == 'nameToId':
+        uid = result
+    elif method == 'idToName':
+        return result and 'found' or 'empty'
+    else:
+        return result and 'listed' or 'empty'
+    if uid >= 0:
+        return 'accepted'
+    return uid == -1 and 'refused' or 'fall_through'
+
+def percentile(ordered, q):
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+def report(results, elapsed):
+    print('%-28s %8s %9s %9s %9s %9s %9s  %s' % ('request', 'count', 'mean[ms]', 'p50[ms]', 'p90[ms]', 'p99[ms]', 'max[ms]', 'outcomes'))
+    count = 0
+    for label in sorted(results):
+        latencies, outcomes = results[label]
+        ordered = sorted(latencies)
+        count += len(ordered)
+        print('%-28s %8d %9.2f %9.2f %9.2f %9.2f %9.2f  %s' % (label, len(ordered),
+              1000 * sum(ordered) / len(ordered),
+              1000 * percentile(ordered, 0.5), 1000 * percentile(ordered, 0.9),
+              1000 * percentile(ordered, 0.99), 1000 * ordered[-1],
+              ', '.join('%s=%d' % item for item in sorted(outcomes.items()))))
+    print('%d requests in %.2fs, %.1f requests/s' % (count, elapsed, count / max(elapsed, 1e-9)))
+
+#
+#--- Stand-in Murmur
+#
+def standin_servants(M):
+    """
+    Meta and Server servants answering just what the authenticators call
+    during their setup. Both the synchronous and the AMD (_async) dispatch
+    forms are provided as Murmur's slice marks the operations amd.
+    """
+    class standinServer(M.Server):
+        def __init__(self):
+            self.authenticator = None
+            self.attached = threading.Event()
+
+        def id(self, current = None):
+            return 1
+
+        def id_async(self, cb, current = None):
+            cb.ice_response(self.id(current))
+
+        def isRunning(self, current = None):
+            return True
+
+        def isRunning_async(self, cb, current = None):
+            cb.ice_response(True)
+
+        def setAuthenticator(self, auth, current = None):
+            self.authenticator = auth
+            self.attached.set()
+
+        def setAuthenticator_async(self, cb, auth, current = None):
+            self.setAuthenticator(auth, current)
+            cb.ice_response()
+
+    class standinMeta(M.Meta):
+        def __init__(self, server):
+            self.server = server
+
+        def getBootedServers(self, current = None):
+            return [self.server]
+
+        def getBootedServers_async(self, cb, current = None):
+            cb.ice_response([self.server])
+
+        def getAllServers(self, current = None):
+            return [self.server]
+
+        def getAllServers_async(self, cb, current = None):
+            cb.ice_response([self.server])
+
+        def addCallback(self, cb, current = None):
+            pass
+
+        def addCallback_async(self, amdcb, cb, current = None):
+            amdcb.ice_response()
+
+        def removeCallback(self, cb, current = None):
+            pass
+
+        def removeCallback_async(self, amdcb, cb, current = None):
+            amdcb.ice_response()
+
+    return standinMeta, standinServer
+
+def free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+    finally:
+        s.close()
+
+def detect_kind(script):
+    path = os.path.abspath(script).lower()
+    if 'ldap' in os.path.basename(path):
+        return 'ldap'
+    if 'phpbb3' in path:
+        return 'phpbb3'
+    if 'elkarte' in path:
+        return 'elkarte'
+    if os.path.join('smf', '1.') in path:
+        return 'smf1'
+    if 'smf' in path:
+        return 'smf2'
+    return None
+
+def write_config(option, kind, workdir, port):
+    """
+    Copies the ini shipped next to the script and points it at the stand-in
+    Murmur and the generated database, then applies the --set overrides
+    """
+    cfg = ConfigParser.RawConfigParser()
+    cfg.optionxform = str
+    cfg.read(os.path.splitext(option.script)[0] + '.ini')
+
+    def put(section, name, value):
+        if not cfg.has_section(section):
+            cfg.add_section(section)
+        cfg.set(section, name, str(value))
+
+    put('ice', 'host', '127.0.0.1')
+    put('ice', 'port', port)
+    put('ice', 'slice', os.path.abspath(option.slice))
+    put('ice', 'secret', '')
+    put('log', 'file', os.path.join(workdir, 'authenticator.log'))
+    put('log', 'level', option.log_level)
+    put('iceraw', 'Ice.ThreadPool.Server.Size', option.server_threads)
+    if kind != 'ldap':
+        put('database', 'lib', os.path.splitext(os.path.basename(__file__))[0])
+        put('database', 'name', os.path.join(workdir, 'forum.sqlite'))
+        put('user', 'avatar_enable', 'False')
+    for setting in option.settings:
+        name, value = setting.split('=', 1)
+        section, name = name.split('.', 1)
+        put(section, name, value)
+
+    filename = os.path.join(workdir, 'authenticator.ini')
+    with open(filename, 'w') as f:
+        cfg.write(f)
+    return cfg, filename
+
+def run_child(kind, script, ini):
+    """
+    Runs the authenticator in this process as if it had been started with
+    -i ini -a, with the ldap module replaced for LDAPauth.py
+    """
+    import runpy
+    if kind == 'ldap':
+        sys.modules.update(ldap_modules(os.environ['LOADTEST_DIRECTORY']))
+    sys.argv = [script, '-i', ini, '-a']
+    runpy.run_path(script, run_name = '__main__')
+
+def main():
+    parser = OptionParser(usage = 'usage: %prog [options] authenticator.py')
+    parser.add_option('-u', '--users', type = 'int', default = 1000,
+                      help = 'registered users to generate [default: %default]')
+    parser.add_option('-n', '--requests', type = 'int', default = 10000,
+                      help = 'requests to send, warmup included [default: %default]')
+    parser.add_option('-c', '--concurrency', type = 'int', default = 10,
+                      help = 'threads sending requests at the same time [default: %default]')
+    parser.add_option('-w', '--warmup', type = 'int', default = 100,
+                      help = 'first requests left out of the report [default: %default]')
+    parser.add_option('--mix', default = 'authenticate=90,nameToId=8,idToName=1,getRegisteredUsers=1',
+                      help = 'relative weights of the callbacks [default: %default]')
+    parser.add_option('--distribution', choices = ['uniform', 'zipf'], default = 'uniform',
+                      help = 'which users log in: uniform or zipf [default: %default]')
+    parser.add_option('--zipf-exponent', type = 'float', dest = 'zipf_exponent', default = 1.1,
+                      help = 'exponent of the zipf distribution [default: %default]')
+    parser.add_option('--unknown', type = 'float', default = 0.05,
+                      help = 'share of names that are not registered [default: %default]')
+    parser.add_option('--wrong', type = 'float', default = 0.05,
+                      help = 'share of logins with a wrong password [default: %default]')
+    parser.add_option('--hash', dest = 'scheme',
+                      help = 'password hash scheme of the generated users: phpass, bcrypt, md5 or sha1 [default: the forum\'s]')
+    parser.add_option('--hash-cost', type = 'int', dest = 'cost',
+                      help = 'cost factor of phpass or bcrypt hashes. Lower it to generate many users faster [default: 11 for phpass, 10 for bcrypt]')
+    parser.add_option('--backend-latency', type = 'float', dest = 'backend_latency', default = 0.0,
+                      help = 'milliseconds added to every query or directory operation [default: %default]')
+    parser.add_option('--slice', default = 'Murmur.ice',
+                      help = 'Murmur.ice or MumbleServer.ice the authenticator uses [default: %default]')
+    parser.add_option('--python', default = sys.executable,
+                      help = 'interpreter to run the authenticator with [default: %default]')
+    parser.add_option('--server-threads', type = 'int', dest = 'server_threads', default = 5,
+                      help = 'Ice.ThreadPool.Server.Size of the authenticator [default: %default]')
+    parser.add_option('--log-level', type = 'int', dest = 'log_level', default = 30,
+                      help = 'log level of the authenticator [default: %default]')
+    parser.add_option('-s', '--set', action = 'append', dest = 'settings', default = [],
+                      help = 'override an ini setting of the authenticator, e.g. user.auth_cache_size=0')
+    parser.add_option('--seed', type = 'int', default = 1,
+                      help = 'seed of the request plan [default: %default]')
+    parser.add_option('--timeout', type = 'float', default = 30.0,
+                      help = 'seconds to wait for the authenticator to attach [default: %default]')
+    parser.add_option('--keep', action = 'store_true', default = False,
+                      help = 'keep the generated database, configuration and log')
+    parser.add_option('--child', nargs = 3, help = 'internal: run kind script ini as the authenticator')
+    (option, args) = parser.parse_args()
+
+    if option.child:
+        run_child(*option.child)
+        return 0
+
+    if len(args) != 1:
+        parser.error('name the authenticator script to test')
+    option.script = os.path.abspath(args[0])
+    kind = detect_kind(option.script)
+    if kind is None:
+        parser.error('cannot tell which authenticator %s is' % args[0])
+    if not os.path.exists(option.slice):
+        parser.error('slice file %s not found, pass it with --slice' % option.slice)
+
+    known = dict(schemes[kind])
+    scheme = option.scheme or schemes[kind][0][0]
+    if scheme not in known:
+        parser.error('%s users cannot have %s hashes' % (kind, scheme))
+    cost = option.cost if option.cost is not None else known[scheme]
+
+    import Ice
+    slicedir = Ice.getSliceDir()
+    if not slicedir:
+        slicedir = ["-I/usr/share/Ice/slice", "-I/usr/share/slice"]
+    else:
+        slicedir = ['-I' + slicedir]
+    Ice.loadSlice('', slicedir + [option.slice])
+    M = __import__(os.path.splitext(os.path.basename(option.slice))[0])
+
+    workdir = tempfile.mkdtemp(prefix = 'mumble-loadtest-')
+    child = None
+    ice = None
+    try:
+        port = free_port()
+        cfg, ini = write_config(option, kind, workdir, port)
+        try:
+            id_offset = cfg.getint('user', 'id_offset')
+        except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+            id_offset = 1000000000
+
+        start = time.time()
+        env = dict(os.environ)
+        env['LOADTEST_BACKEND_LATENCY'] = str(option.backend_latency / 1000.0)
+        if kind == 'ldap':
+            env['LOADTEST_DIRECTORY'] = os.path.join(workdir, 'directory.json')
+            seed_directory(env['LOADTEST_DIRECTORY'], cfg, option.users)
+        else:
+            try:
+                prefix = cfg.get('database', 'prefix')
+            except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+                prefix = ''
+            seed_database(cfg.get('database', 'name'), kind, prefix, option.users, scheme, cost)
+        print('Generated %d %s users (%s %d) in %.1fs' % (option.users, kind, scheme, cost, time.time() - start))
+
+        initdata = Ice.InitializationData()
+        initdata.properties = Ice.createProperties([], initdata.properties)
+        initdata.properties.setProperty('Ice.Default.EncodingVersion', '1.0')
+        initdata.properties.setProperty('Ice.ThreadPool.Server.Size', '2')
+        ice = Ice.initialize(initdata)
+        adapter = ice.createObjectAdapterWithEndpoints('Murmur', 'tcp -h 127.0.0.1 -p %d' % port)
+        identity = getattr(Ice, 'stringToIdentity', ice.stringToIdentity)
+        standinMeta, standinServer = standin_servants(M)
+        server = standinServer()
+        serverprx = M.ServerPrx.uncheckedCast(adapter.add(server, identity('s/1')))
+        adapter.add(standinMeta(serverprx), identity('Meta'))
+        adapter.activate()
+
+        output = open(os.path.join(workdir, 'authenticator.out'), 'w')
+        child = subprocess.Popen([option.python, os.path.abspath(__file__), '--child', kind, option.script, ini],
+                                 cwd = workdir, env = env, stdout = output, stderr = subprocess.STDOUT)
+        output.close()
+
+        deadline = time.time() + option.timeout
+        while not server.attached.wait(0.1):
+            if child.poll() is not None or time.time() > deadline:
+                print('The authenticator did not attach, its output and log are in %s' % workdir, file = sys.stderr)
+                option.keep = True
+                return 1
+
+        auth = M.ServerUpdatingAuthenticatorPrx.uncheckedCast(server.authenticator)
+        plan = build_plan(option, id_offset)
+        results = {}
+        lock = threading.Lock()
+        position = [0]
+        window = [None, None]
+
+        def worker():
+            while True:
+                lock.acquire()
+                try:
+                    n = position[0]
+                    position[0] += 1
+                    if n == option.warmup:
+                        window[0] = time.time()
+                finally:
+                    lock.release()
+                if n >= len(plan):
+                    return
+
+                label, method, args = plan[n]
+                begin = time.time()
+                try:
+                    result = outcome(method, getattr(auth, method)(*args))
+                except Ice.Exception as e:
+                    result = e.__class__.__name__
+                elapsed = time.time() - begin
+                if n < option.warmup:
+                    continue
+
+                lock.acquire()
+                try:
+                    latencies, outcomes = results.setdefault(label, ([], {}))
+                    latencies.append(elapsed)
+                    outcomes[result] = outcomes.get(result, 0) + 1
+                    window[1] = time.time()
+                finally:
+                    lock.release()
+
+        threads = [threading.Thread(target = worker) for i in xrange(option.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if not results:
+            print('No requests left after the warmup', file = sys.stderr)
+            return 1
+        report(results, window[1] - window[0])
+        return 0
+    finally:
+        if child is not None and child.poll() is None:
+            child.terminate()
+            for i in xrange(100):
+                if child.poll() is not None:
+                    break
+                time.sleep(0.1)
+            else:
+                child.kill()
+        if ice is not None:
+            ice.destroy()
+        if not option.keep:
+            shutil.rmtree(workdir, ignore_errors = True)
+
+#
+#--- Start of program
+#
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+
+# Copyright (C) 2026 The Mumble Developers
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+# - Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# - Neither the name of the Mumble Developers nor the names of its
+#   contributors may be used to endorse or promote products derived from this
+#   software without specific prior written permission.
+
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# `AS IS'' AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR
+# A PARTICULAR PURPOSE ARE DISCLAIMED.  IN NO EVENT SHALL THE FOUNDATION OR
+# CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL,
+# EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO,
+# PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR
+# PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF
+# LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING
+# NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+#
+#    hashbench.py - Compares the phpBB3 salted md5 ($H$) implementation of
+#                   phpBB3auth.py with the original character based one
+#
+#    Every hash is computed by both implementations and has to match bit for
+#    bit, the timings of both are printed per cost factor.
+#
+#    Requirements:
+#        * python >=2.7 and the modules phpBB3auth.py needs to be imported
+#          (ice-python)
+#
+
+import os
+import sys
+import time
+
+from hashlib  import md5
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from phpBB3auth import _hash_crypt_private
+
+itoa64 = './0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+
+#
+#--- Reference implementation as originally shipped with phpBB3auth.py
+#
+def reference_hash_encode64(sinput, count, itoa64):
+    output = ''
+    i = 0
+    while True:
+        value = ord(sinput[i])
+        i += 1
+        output += itoa64[value & 0x3f]
+
+        if i < count:
+            value |= (ord(sinput[i]) << 8)
+
+        output += itoa64[(value >> 6) & 0x3f]
+
+        if i >= count:
+            break
+        i += 1
+
+        if i < count:
+            value |= (ord(sinput[i]) << 16)
+
+        output += itoa64[(value >> 12) & 0x3f]
+
+        if i >= count:
+            break
+
+        i = i + 1
+        output += itoa64[(value >> 18) & 0x3f]
+        if i >= count:
+            break
+    return output
+
+def reference_hash_crypt_private(password, settings, itoa64):
+    output = '*'
+
+    if settings[0:3] != '$H$':
+        return output
+
+    try:
+        count_log2 = itoa64.index(settings[3])
+    except ValueError:
+        return output
+
+    if (count_log2 < 7) or (count_log2 > 30):
+        return output
+
+    count = 1 << count_log2
+    salt = settings[4:12]
+
+    if len(salt) != 8:
+        return output
+
+
+    hash = md5(salt + password).digest()
+
+    while True:
+        hash = md5(hash + password).digest()
+        count = count - 1
+        if count <= 0:
+            break
+
+    output = settings[0:12]
+    output += reference_hash_encode64(hash, 16, itoa64)
+
+    return output
+
+def random_settings(cost):
+    salt = ''.join([itoa64[ord(c) & 0x3f] for c in os.urandom(8)])
+    return '$H$' + itoa64[cost] + salt
+
+def measure(func, password, settings, repeat):
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        result = func(password, settings, itoa64)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return result, best
+
+#
+#--- Start of program
+#
+if __name__ == '__main__':
+    parser = OptionParser()
+    parser.add_option('--min-cost', type = 'int', dest = 'min_cost', default = 7,
+                      help = 'smallest cost factor to measure [default: %default]')
+    parser.add_option('--max-cost', type = 'int', dest = 'max_cost', default = 18,
+                      help = 'largest cost factor to measure, at most 30. Every step doubles the runtime [default: %default]')
+    parser.add_option('-r', '--repeat', type = 'int', dest = 'repeat', default = 3,
+                      help = 'runs per cost factor, the fastest one is reported [default: %default]')
+    parser.add_option('-p', '--password', dest = 'password', default = 'correct horse battery staple',
+                      help = 'password to hash')
+    (option, args) = parser.parse_args()
+
+    if option.min_cost < 7 or option.max_cost > 30 or option.min_cost > option.max_cost:
+        parser.error('cost factors have to be in the range 7..30')
+
+    failed = False
+    print '%4s %14s %14s %8s' % ('cost', 'reference [s]', 'current [s]', 'speedup')
+    for cost in xrange(option.min_cost, option.max_cost + 1):
+        settings = random_settings(cost)
+        expected, reference = measure(reference_hash_crypt_private, option.password, settings, option.repeat)
+        result, current = measure(_hash_crypt_private, option.password, settings, option.repeat)
+
+        if result != expected:
+            failed = True
+            print '%4d MISMATCH %s != %s' % (cost, result, expected)
+            continue
+
+        print '%4d %14.6f %14.6f %7.2fx' % (cost, reference, current, reference / max(current, 1e-9))
+
+    sys.exit(failed and 1 or 0)